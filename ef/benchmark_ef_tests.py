@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Copyright (C) 2015 Michael M Mysinger
+
+Benchmark vectorized chi-square and Fisher's exact tests for EF analysis.
+"""
+
+import os
+import sys
+import logging
+from argparse import ArgumentParser
+
+import csv
+import time
+import numpy as np
+from scipy import stats
+
+module_path = os.path.realpath(os.path.dirname(__file__))
+labware_path = os.path.join(module_path, "..")
+sys.path.append(labware_path)
+from libraries.lab_utils import ScriptError, gopen
+from ef.ef_analysis import Contingencies, chi2_contingencies, \
+    fisher_contingencies
+
+DEFAULT_SEED = 42
+DEFAULT_NUM_TABLES = 100000
+DEFAULT_NUM_SCALAR = 2000
+DEFAULT_REPEATS = 3
+
+
+def random_contingencies(num_tables, num_pairs=1000000):
+    """Draw low-count contingency tables like those passing min_pairs"""
+    both = np.random.geometric(0.1, num_tables) + 3
+    events = np.random.geometric(0.002, num_tables) + both
+    targets = np.random.geometric(0.002, num_tables) + both
+    neither = num_pairs - both - events - targets
+    return Contingencies(both, events, targets, neither)
+
+
+def time_call(function, repeats):
+    """Return the best wall clock time over repeated calls"""
+    best = None
+    for i in xrange(repeats):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def benchmark_ef_tests(num_tables=DEFAULT_NUM_TABLES,
+                       num_scalar=DEFAULT_NUM_SCALAR, repeats=DEFAULT_REPEATS,
+                       random_seed=DEFAULT_SEED):
+    """Benchmark vectorized chi-square and Fisher's exact tests"""
+    logging.info("Using random seed %d" % random_seed)
+    np.random.seed(random_seed)
+    tables = random_contingencies(num_tables)
+    logging.info("Timing %d contingency tables, best of %d" % (num_tables,
+                                                                repeats))
+    chi2_time, (chi2, chi2_p) = time_call(
+        lambda: chi2_contingencies(tables), repeats)
+    fisher_time, fisher_p = time_call(
+        lambda: fisher_contingencies(tables), repeats)
+    # Per-table scipy call on a subset, extrapolated to the full count
+    num_scalar = min(num_scalar, num_tables)
+    subset = zip(tables.both, tables.events, tables.targets,
+                 tables.neither)[:num_scalar]
+    scalar_time, scalar_p = time_call(
+        lambda: [stats.fisher_exact([[a, b], [c, d]],
+                                    alternative="greater")[1]
+                 for a, b, c, d in subset], 1)
+    scalar_time *= float(num_tables) / num_scalar
+    max_error = np.max(np.abs(fisher_p[:num_scalar] - scalar_p) /
+                       np.maximum(scalar_p, np.finfo(float).tiny))
+    yield ["method", "tables", "seconds", "tables_per_second"]
+    for method, seconds in (("chi2_vectorized", chi2_time),
+                            ("fisher_vectorized", fisher_time),
+                            ("fisher_exact_per_table", scalar_time)):
+        logging.info("%s: %.3f s" % (method, seconds))
+        yield [method, num_tables, "%.4g" % seconds,
+               "%.4g" % (num_tables / seconds)]
+    logging.info("Fisher vectorized to chi-square cost ratio: %.2f" %
+                 (fisher_time / chi2_time))
+    logging.info("Max relative Fisher p-value error versus scipy: %.3g" %
+                 max_error)
+
+
+def handler(out_fn=None, **kwargs):
+    """I/O handling for the script."""
+    if out_fn is None:
+        out_f = sys.stdout
+        out_location = "standard out"
+    else:
+        out_f = gopen(out_fn, "w")
+        out_location = out_fn
+    logging.info("Output file: %s" % out_location)
+    out_writer = csv.writer(out_f)
+    try:
+        try:
+            for result in benchmark_ef_tests(**kwargs):
+                out_writer.writerow(result)
+        except ScriptError, message:
+            logging.error(message)
+            return message.value
+    finally:
+        if out_f is not sys.stdout:
+            out_f.close()
+    return 0
+
+
+def main(argv):
+    """Parse arguments."""
+    logging.basicConfig(level=logging.INFO,
+                        format="%(levelname)s: %(message)s")
+    description = "Benchmark vectorized chi-square and Fisher's exact " + \
+                  "tests for EF analysis"
+    parser = ArgumentParser(description=description)
+    parser.add_argument("-n", "--num-tables", type=int,
+        default=DEFAULT_NUM_TABLES,
+        help="number of random contingency tables (default: %(default)s)")
+    parser.add_argument("-s", "--num-scalar", type=int,
+        default=DEFAULT_NUM_SCALAR,
+        help="number of tables to time with per-table scipy calls " +
+             "(default: %(default)s)")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS,
+                        help="timing repeats (default: %(default)s)")
+    parser.add_argument("-r", "--random-seed", default=DEFAULT_SEED, type=int,
+                        help="set random integer seed (default: %(default)d)")
+    parser.add_argument("-o", "--outfile", default=None,
+                        help="output CSV file (default: stdout)")
+    options = parser.parse_args(args=argv[1:])
+    return handler(out_fn=options.outfile, num_tables=options.num_tables,
+                   num_scalar=options.num_scalar, repeats=options.repeats,
+                   random_seed=options.random_seed)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
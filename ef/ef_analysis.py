@@ -13,25 +13,89 @@ import os
 import sys
 import logging
 import os.path as op
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 
 import csv
+import zlib
+import time
+import resource
+import json
+import shutil
+import heapq
+import hashlib
+import tempfile
+from array import array
+import multiprocessing
 from collections import namedtuple, defaultdict, Counter
 import numpy as np
 from scipy import stats
-from statsmodels.stats.multitest import multipletests
+from scipy import sparse
+from scipy.special import gammaln
 
 module_path = os.path.realpath(os.path.dirname(__file__)) 
 labware_path = os.path.join(module_path, "..")
 sys.path.append(labware_path)
-from libraries.lab_utils import ScriptError, gopen
+from libraries.lab_utils import ScriptError, gopen, Interner, \
+    read_interners, write_interners
+from libraries.multitest import adjust_pvalues, METHODS
 
 Target = namedtuple("Target", "name description")
+Incidence = namedtuple("Incidence", 
+                       "drugs events targets drug_events drug_targets weights")
+# Unweighted incidence has one row per molecule
+Incidence.__new__.__defaults__ = (None,)
+EFTable = namedtuple("EFTable", "events targets pairs efs")
+Contingencies = namedtuple("Contingencies", "both events targets neither")
+ContingencySums = namedtuple("ContingencySums", 
+                             "both event_sums target_sums num_pairs")
+EFState = namedtuple("EFState", "results_hash vocabulary targets " 
+                     "drug_events drug_targets pair_counts both E event_sums")
 
 # XXX - MMM currently set for bitterdb, may want better defaults 
 CUTOFF_MINPAIRS = 4       # Nat2012: Target-ADR pairs > 10 retained
 CUTOFF_EF = 3.0           # Nat2012: EF > 1
 CUTOFF_QVALUE = 1.0e-3    
+ENGINES = ("sparse", "sets")
+VOCABULARY_KINDS = ("molecule", "target", "event")
+TESTS = ("chi2", "fisher")
+CHUNKS_PER_JOB = 4
+PLAN_SAMPLE_EVENTS = 2000
+PLAN_LINK_BLOCK = 1 << 18
+SAMPLE_REPEATS = 10
+SAMPLE_SEED = 42
+SAMPLE_CONFIDENCE = 95.0
+EVENT_CHUNK = 256
+BOOTSTRAP_BATCH = 100
+NULL_BATCH = 1000
+# Width of the log2 event size bins that random clusters are matched to
+NULL_BIN_WIDTH = 0.5
+MIN_PARTITIONS = 16
+MAX_PARTITIONS = 1024
+PARTITION_BUFFER = 1 << 13
+# Out-of-core bytes per drug-target pair, per drug-event-target product 
+# term, per sorted p-value, and per tested table
+PARTITION_PAIR_BYTES = 64
+PARTITION_FLOP_BYTES = 8
+SORT_PAIR_BYTES = 256
+TEST_PAIR_BYTES = 2048
+# Rough costs per unit of work, measured on a 1500 event by 1500 target run
+PLAN_COSTS = {"read_row_seconds": 2.0e-6, 
+              "product_flop_seconds": 3.2e-8, 
+              "sparse_pair_seconds": 1.3e-6, 
+              "test_pair_seconds": {"chi2": 1.3e-6, "fisher": 4.0e-6}, 
+              "output_pair_seconds": 0.7e-6, 
+              "sets_probe_seconds": 1.1e-7, 
+              "sets_link_seconds": 2.3e-7, 
+              "base_bytes": 40e6, 
+              "sparse_row_bytes": 24, 
+              "sparse_product_bytes": 48, 
+              "sparse_pair_bytes": 220, 
+              "sets_link_bytes": 120, 
+              "sets_pair_bytes": 560}
+FISHER_TOLERANCE = 1.0e-17
+# Newer scipy caps Yates' correction at the distance to the expected 
+# frequency, older scipy always moves by 0.5, so follow the installed one
+YATES_CAPPED = stats.chi2_contingency([[1, 1], [1, 2]])[0] == 0.0
 
 
 def flip_setdict(in_dict):
@@ -51,22 +115,81 @@ def flatten_setdict(in_dict):
     return out_set
 
 
-def read_events(events_reader):
-    """Read events to molecules mapping"""
+def in_shard(eid, shard):
+    """Check if an event belongs to shard (index, count) by stable hash"""
+    index, count = shard
+    return (zlib.crc32(eid) & 0xffffffff) % count == index
+
+
+class RereadableReader(object):
+    """CSV reader over a seekable file, restarting on every iteration"""
+
+    def __init__(self, in_f):
+        self.in_f = in_f
+
+    def __iter__(self):
+        self.in_f.seek(0)
+        return csv.reader(self.in_f)
+
+
+def rereadable(reader):
+    """Check if a reader can be iterated over more than once"""
+    return iter(reader) is not reader
+
+
+def read_event_molecules(events_reader, shard=None):
+    """Quick first pass reading only the molecules that have events"""
+    logging.info("Reading event molecules")
+    has_event = set()
+    for row in events_reader:
+        cid, eid = row[:2]
+        if shard is not None and not in_shard(eid, shard):
+            continue
+        has_event.add(cid)
+    return has_event
+
+
+def read_events(events_reader, shard=None, has_target=None):
+    """Read events to molecules mapping, pruned to has_target if given"""
     logging.info("Reading events")
     events_to_drugs = defaultdict(set)
     for row in events_reader:
         cid, eid = row[:2]
+        if shard is not None and not in_shard(eid, shard):
+            continue
         # IDEA - may want two optional columns, for extra drug and event info
         # read Garrett's file format
         #cid, altid, eid = row
-        events_to_drugs[eid].add(cid)
+        drugs = events_to_drugs[eid]
+        # Events keep their entry when pruned empty, as in prune_events
+        if has_target is None or cid in has_target:
+            drugs.add(cid)
     has_event = flatten_setdict(events_to_drugs)
     logging.info("Mapped %d events to %d molecules" % (
         len(events_to_drugs), len(has_event)))
     return events_to_drugs, has_event
 
 
+def read_pruned_sets(events_reader, results_reader, shard=None):
+    """Read events and results as pruned sets, pruning on read when the 
+    events can be read twice, so unpruned event sets never exist"""
+    if not rereadable(events_reader):
+        events_to_drugs, has_event = read_events(events_reader, shard=shard)
+        targets_to_drugs, has_target, targets = read_results(results_reader, 
+                                                             has_event)
+        events_to_drugs = prune_events(events_to_drugs, has_event, 
+                                       has_target)
+        return events_to_drugs, targets_to_drugs, targets
+    has_event = read_event_molecules(events_reader, shard=shard)
+    targets_to_drugs, has_target, targets = read_results(results_reader, 
+                                                         has_event)
+    events_to_drugs, has_linked = read_events(events_reader, shard=shard, 
+                                              has_target=has_target)
+    logging.info("Pruned %d event molecules that were not mapped to targets" % 
+                 len(has_event - has_linked))
+    return events_to_drugs, targets_to_drugs, targets
+
+
 def read_results(results_reader, has_event):
     """Read targets to molecules mapping"""
     logging.info("Reading targets")
@@ -159,7 +282,318 @@ def compute_efs(E, T, events_to_drugs, targets_to_drugs,
     return efs
 
 
-def map_contingency_tables(efs, events_to_drugs, targets_to_drugs):
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """Peak resident set size in MB, where Linux reports kilobytes"""
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+
+class StageTimer(object):
+    """Log wall clock time and peak RSS as each pipeline stage finishes"""
+
+    def __init__(self, workers=False):
+        self.start = time.time()
+        self.workers = workers
+
+    def __call__(self, stage):
+        now = time.time()
+        message = "Stage %s took %.2f s, peak RSS %.1f MB" % (
+            stage, now - self.start, peak_rss_mb())
+        if self.workers:
+            message += ", %.1f MB in worker processes" % peak_rss_mb(
+                resource.RUSAGE_CHILDREN)
+        logging.info(message)
+        self.start = now
+
+
+def new_vocabulary():
+    """Create empty molecule, target, and event interners"""
+    return dict((kind, Interner()) for kind in VOCABULARY_KINDS)
+
+
+def read_vocabulary(vocabulary_fn):
+    """Read persisted ID interners, or start new ones"""
+    vocabulary = new_vocabulary()
+    if vocabulary_fn and op.exists(vocabulary_fn):
+        logging.info("Reading ID vocabulary: %s" % vocabulary_fn)
+        vocabulary_f = gopen(vocabulary_fn)
+        try:
+            vocabulary.update(read_interners(vocabulary_f))
+        finally:
+            vocabulary_f.close()
+        logging.info("Vocabulary holds %d molecules, %d targets, and %d " 
+                     "events" % tuple(len(vocabulary[kind]) for kind in 
+                                      VOCABULARY_KINDS))
+    return vocabulary
+
+
+def write_vocabulary(vocabulary_fn, vocabulary):
+    """Persist ID interners, so later runs keep the same codes"""
+    logging.info("Writing ID vocabulary: %s" % vocabulary_fn)
+    vocabulary_f = gopen(vocabulary_fn, "w")
+    try:
+        write_interners(vocabulary_f, vocabulary)
+    finally:
+        vocabulary_f.close()
+
+
+def read_event_codes(events_reader, vocabulary, shard=None):
+    """Read events to molecules mapping as interned integer codes"""
+    logging.info("Reading events")
+    molecules = vocabulary["molecule"]
+    events = vocabulary["event"]
+    drug_codes = array("i")
+    event_codes = array("i")
+    for row in events_reader:
+        cid, eid = row[:2]
+        if shard is not None and not in_shard(eid, shard):
+            continue
+        drug_codes.append(molecules.intern(cid))
+        event_codes.append(events.intern(eid))
+    drug_codes = np.frombuffer(drug_codes, dtype=np.int32)
+    event_codes = np.frombuffer(event_codes, dtype=np.int32)
+    has_event = np.zeros(len(molecules), dtype=bool)
+    has_event[drug_codes] = True
+    logging.info("Mapped %d events to %d molecules" % (
+        len(np.unique(event_codes)), has_event.sum()))
+    return (drug_codes, event_codes), has_event
+
+
+def read_result_codes(results_reader, vocabulary, has_event=None, 
+                      tiers=None):
+    """Read targets to molecules mapping as interned integer codes
+
+    When given a tiers interner, affinity groups are interned into it and 
+    their codes returned as a third array of target edges.
+    """
+    logging.info("Reading targets")
+    header = results_reader.next()
+    logging.info("Skipping SEAware results header: %s" % str(header))
+    molecules = vocabulary["molecule"]
+    target_ids = vocabulary["target"]
+    targets = {}
+    drug_codes = array("i")
+    target_codes = array("i")
+    tier_codes = array("i")
+    rejects = set()
+    for row in results_reader:
+        cid, smiles, tid, affinity, pvalue, maxtc, name, desc = row
+        if has_event is None:
+            # Keep every molecule, for incremental runs that add events
+            code = molecules.intern(cid)
+        else:
+            code = molecules.get(cid)
+            if code is None or not has_event[code]:
+                rejects.add(cid)
+                continue
+        # implicitly takes the union over remaining affinity groups
+        drug_codes.append(code)
+        target_codes.append(target_ids.intern(tid))
+        if tiers is not None:
+            tier_codes.append(tiers.intern(affinity))
+        if tid not in targets:
+            targets[tid] = Target(name, desc)
+    drug_codes = np.frombuffer(drug_codes, dtype=np.int32)
+    target_codes = np.frombuffer(target_codes, dtype=np.int32)
+    has_target = np.zeros(len(molecules), dtype=bool)
+    has_target[drug_codes] = True
+    logging.info("Skipped %d target molecules that were not mapped to events" % 
+                 len(rejects))
+    logging.info("Mapped %d targets to %d molecules" % (
+        len(targets), has_target.sum()))
+    if tiers is not None:
+        tier_codes = np.frombuffer(tier_codes, dtype=np.int32)
+        return (drug_codes, target_codes, tier_codes), has_target, targets
+    return (drug_codes, target_codes), has_target, targets
+
+
+def edges_to_matrix(rows, cols, shape):
+    """Convert interned code pairs into a sparse 0/1 incidence matrix"""
+    data = np.ones(len(rows), dtype=np.int32)
+    matrix = sparse.coo_matrix((data, (rows, cols)), shape=shape).tocsc()
+    # Duplicate pairs were summed, so reset them to single links
+    matrix.data[:] = 1
+    return matrix
+
+
+def build_incidence(vocabulary, event_edges, target_edges, has_event, 
+                    has_target):
+    """Build pruned sparse drug x event and drug x target matrices"""
+    # Prune event molecules that are not mapped to targets
+    keep = has_target[event_edges[0]]
+    logging.info("Pruned %d event molecules that were not mapped to targets" % 
+                 (has_event & ~has_target).sum())
+    logging.info("Building sparse incidence matrices")
+    molecules = vocabulary["molecule"]
+    events = vocabulary["event"]
+    targets = vocabulary["target"]
+    drug_events = edges_to_matrix(event_edges[0][keep], event_edges[1][keep], 
+                                  (len(molecules), len(events)))
+    drug_targets = edges_to_matrix(target_edges[0], target_edges[1], 
+                                   (len(molecules), len(targets)))
+    logging.info("Incidence matrices hold %d drug-event and %d drug-target " 
+                 "pairs over %d molecules" % (drug_events.nnz, 
+                 drug_targets.nnz, has_target.sum()))
+    return Incidence(molecules.names, events.names, targets.names, 
+                     drug_events, drug_targets)
+
+
+def collapse_incidence(incidence):
+    """Merge molecules with identical event and target sets into weighted 
+    rows, which leave every pair count and contingency sum unchanged"""
+    if incidence.weights is not None:
+        return incidence
+    signatures = sparse.hstack([incidence.drug_events, 
+                                incidence.drug_targets], format="csr")
+    signatures.sort_indices()
+    indptr, indices = signatures.indptr, signatures.indices
+    groups = {}
+    codes = np.empty(len(indptr) - 1, dtype=np.int64)
+    for i in xrange(len(codes)):
+        key = indices[indptr[i]:indptr[i+1]].tostring()
+        codes[i] = groups.setdefault(key, len(groups))
+    del signatures, groups
+    # Keep the first molecule of each group as its representative row
+    unique_codes, firsts, weights = np.unique(codes, return_index=True, 
+                                              return_counts=True)
+    weights = weights.astype(np.int64)
+    # Molecules without events or targets add nothing, so drop their row
+    linked = ((np.diff(incidence.drug_events.tocsr().indptr) > 0) & 
+              (np.diff(incidence.drug_targets.tocsr().indptr) > 0))[firsts]
+    firsts, weights = firsts[linked], weights[linked]
+    if weights.sum() == len(weights):
+        logging.info("Found no equivalent molecules to collapse")
+        return incidence
+    logging.info("Collapsed %d linked molecules into %d weighted rows" % 
+                 (weights.sum(), len(weights)))
+    return Incidence([incidence.drugs[i] for i in firsts], incidence.events, 
+                     incidence.targets, 
+                     incidence.drug_events.tocsr()[firsts].tocsc(), 
+                     incidence.drug_targets.tocsr()[firsts].tocsc(), weights)
+
+
+def weighted_drug_targets(incidence):
+    """Drug x target incidence scaled by each row's molecule count"""
+    if incidence.weights is None:
+        return incidence.drug_targets
+    return sparse.diags(incidence.weights, 0).dot(incidence.drug_targets)
+
+
+def compute_pair_counts(incidence):
+    """Compute pte counts, E, T, and P from one sparse matrix product"""
+    # pte[event, target] counts molecules linking each target-event pair, 
+    # so its row sums are E, its column sums are T, and its total is P
+    pair_counts = incidence.drug_events.T.tocsr().dot(
+        weighted_drug_targets(incidence).tocsc()).tocsr()
+    E = np.asarray(pair_counts.sum(axis=1), dtype=np.int64).ravel()
+    T = np.asarray(pair_counts.sum(axis=0), dtype=np.int64).ravel()
+    P = int(E.sum())
+    return pair_counts, E, T, P
+
+
+# Incidence shared with forked workers, so it is never pickled per task
+_worker_incidence = None
+
+
+def pair_counts_worker(event_slice):
+    """Compute partial pair counts, T, and P for a slice of events"""
+    start, stop = event_slice
+    drug_events = _worker_incidence.drug_events[:, start:stop]
+    pair_counts = drug_events.T.tocsr().dot(
+        _worker_incidence.drug_targets).tocsr()
+    T = np.asarray(pair_counts.sum(axis=0), dtype=np.int64).ravel()
+    P = int(T.sum())
+    return pair_counts, T, P
+
+
+def compute_pair_counts_parallel(incidence, jobs):
+    """Compute pte counts, E, T, and P with events split across processes"""
+    global _worker_incidence
+    num_events = len(incidence.events)
+    # Balance slices by drug-event incidence rather than by event count
+    bounds = np.searchsorted(incidence.drug_events.indptr, 
+        np.linspace(0, incidence.drug_events.nnz, jobs*CHUNKS_PER_JOB + 1))
+    bounds[0], bounds[-1] = 0, num_events
+    slices = [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) 
+              if stop > start]
+    logging.info("Computing pair counts for %d event slices with %d jobs" % 
+                 (len(slices), jobs))
+    # Workers share the weighted targets, computed once before forking
+    _worker_incidence = incidence._replace(
+        drug_targets=weighted_drug_targets(incidence).tocsc(), weights=None)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        partials = pool.map(pair_counts_worker, slices)
+    finally:
+        pool.terminate()
+        pool.join()
+        _worker_incidence = None
+    # Reduce partial results in event order, so output matches serial runs
+    if partials:
+        pair_counts = sparse.vstack([pte for pte, T, P in partials], 
+                                    format="csr")
+    else:
+        pair_counts = sparse.csr_matrix((num_events, len(incidence.targets)), 
+                                        dtype=np.int32)
+    E = np.asarray(pair_counts.sum(axis=1), dtype=np.int64).ravel()
+    T = np.zeros(len(incidence.targets), dtype=np.int64)
+    P = 0
+    for partial_pte, partial_T, partial_P in partials:
+        T += partial_T
+        P += partial_P
+    return pair_counts, E, T, P
+
+
+def compute_efs_sparse(incidence, min_pairs=CUTOFF_MINPAIRS, jobs=1):
+    """Compute enrichment factors using sparse incidence matrices"""
+    if jobs > 1:
+        pair_counts, E, T, P = compute_pair_counts_parallel(incidence, jobs)
+    else:
+        pair_counts, E, T, P = compute_pair_counts(incidence)
+    return efs_from_pair_counts(pair_counts, E, T, P, min_pairs=min_pairs)
+
+
+def efs_from_pair_counts(pair_counts, E, T, P, min_pairs=CUTOFF_MINPAIRS):
+    """Compute enrichment factors from reduced pair counts, E, T, and P"""
+    if min_pairs > 0:
+        coo = pair_counts.tocoo()
+        keep = coo.data >= min_pairs
+        rows, cols, pte = coo.row[keep], coo.col[keep], coo.data[keep]
+    else:
+        # Zero counts also pass, so consider every pair with a linked event
+        dense = pair_counts.toarray()
+        dense[E == 0, :] = -1
+        dense[:, T == 0] = -1
+        rows, cols = np.nonzero(dense >= min_pairs)
+        pte = dense[rows, cols]
+    # Same operation order as compute_efs, so both engines agree exactly
+    efs = pte.astype(np.float64) / (E[rows] * T[cols])
+    efs = efs * P
+    logging.info("Computed %d target-event enrichment factors" % len(efs))
+    return EFTable(rows, cols, pte, efs)
+
+
+def select_pairs(table, mask):
+    """Select the same rows from every parallel array of a pair table"""
+    return type(table)(*[x[mask] for x in table])
+
+
+def efs_dict_to_table(efs, events_to_drugs, targets_to_drugs):
+    """Convert set engine EFs into a pair table with sorted name lists"""
+    events = sorted(events_to_drugs)
+    targets = sorted(targets_to_drugs)
+    event_index = dict((event, i) for i, event in enumerate(events))
+    target_index = dict((target, i) for i, target in enumerate(targets))
+    keys = sorted(efs, key=lambda k: (event_index[k[1]], target_index[k[0]]))
+    rows = np.array([event_index[e] for t, e in keys], dtype=np.int64)
+    cols = np.array([target_index[t] for t, e in keys], dtype=np.int64)
+    pte = np.array([len(events_to_drugs[e] & targets_to_drugs[t]) for 
+                    t, e in keys], dtype=np.int64)
+    ef_array = np.array([efs[k] for k in keys], dtype=np.float64)
+    return EFTable(rows, cols, pte, ef_array), events, targets
+
+
+def map_contingency_tables(efs, events_to_drugs, targets_to_drugs, 
+                           event_names, target_names):
     """Calculate contingency table for every target-event pair"""
     # Count number of drug-target pairs for each drug
     target_counts = Counter()
@@ -168,77 +602,1996 @@ def map_contingency_tables(efs, events_to_drugs, targets_to_drugs):
     num_pairs = sum(target_counts.itervalues())
     # Use counts to quickly compute contingency sums
     logging.info("Computing contingency tables")
-    contingency_tables = {}
-    for target, event in efs.iterkeys():
-        e_drugs = events_to_drugs[event]
-        t_drugs = targets_to_drugs[target]
-        both = sum(target_counts[x] for x in e_drugs & t_drugs) 
-        events = sum(target_counts[x] for x in e_drugs) - both
-        targets = sum(target_counts[x] for x in t_drugs) - both
-        neither = num_pairs - both - events - targets
-        contingency_tables[(target, event)] = np.array([[both, events], 
-                                                        [targets, neither]])
-    return contingency_tables
-
-
-def compute_q_values(contingencies, bonferroni_count=None):
-    """Compute p and q-values"""
-    logging.info("Computing p and q-values")
-    target_event_pairs = []
-    p_vals = []
-    for (target, event), table in contingencies.iteritems():
-        chi2, pvalue, ddof, expected = stats.chi2_contingency(table)
-        target_event_pairs.append((target, event))
-        p_vals.append(pvalue)
+    num_tables = len(efs.efs)
+    both = np.zeros(num_tables, dtype=np.int64)
+    events = np.zeros(num_tables, dtype=np.int64)
+    targets = np.zeros(num_tables, dtype=np.int64)
+    for i in xrange(num_tables):
+        e_drugs = events_to_drugs[event_names[efs.events[i]]]
+        t_drugs = targets_to_drugs[target_names[efs.targets[i]]]
+        both[i] = sum(target_counts[x] for x in e_drugs & t_drugs) 
+        events[i] = sum(target_counts[x] for x in e_drugs) - both[i]
+        targets[i] = sum(target_counts[x] for x in t_drugs) - both[i]
+    neither = num_pairs - both - events - targets
+    return Contingencies(both, events, targets, neither)
+
+
+def contingency_sums(incidence):
+    """Pre-compute the sparse sums behind every contingency table"""
+    drug_events = incidence.drug_events
+    drug_targets = incidence.drug_targets
+    # Count number of drug-target pairs for each drug
+    target_counts = np.asarray(drug_targets.sum(axis=1), 
+                               dtype=np.int64).ravel()
+    # Weighted rows stand for several identical molecules
+    if incidence.weights is not None:
+        target_counts *= incidence.weights
+    num_pairs = int(target_counts.sum())
+    # Weighted sums over each full event and target, computed only once
+    event_sums = drug_events.T.dot(target_counts)
+    target_sums = drug_targets.T.dot(target_counts)
+    # Weighted product gives both for every linked pair in one pass
+    weighted = sparse.diags(target_counts, 0).dot(drug_targets).tocsc()
+    both = drug_events.T.tocsr().dot(weighted).tocsr()
+    return ContingencySums(both, event_sums, target_sums, num_pairs)
+
+
+def contingencies_from_sums(efs, sums):
+    """Look up contingency tables for the EF pairs from pre-computed sums"""
+    rows, cols = efs.events, efs.targets
+    if sparse.issparse(sums.both):
+        both = np.zeros(len(rows), dtype=np.int64)
+        if len(rows):
+            both[:] = np.asarray(sums.both[rows, cols]).ravel()
+    else:
+        # Already summed for just these pairs
+        both = sums.both
+    events = sums.event_sums[rows] - both
+    targets = sums.target_sums[cols] - both
+    neither = sums.num_pairs - both - events - targets
+    return Contingencies(both, events, targets, neither)
+
+
+def map_contingency_tables_sparse(efs, incidence):
+    """Calculate contingency tables for all target-event pairs in bulk"""
+    logging.info("Computing contingency tables")
+    return contingencies_from_sums(efs, contingency_sums(incidence))
+
+
+def tested_contingencies(efs, contingency_function, bonferroni=False,
+                         ef_cutoff=CUTOFF_EF):
+    """Select the pairs to test and compute their contingency tables
+
+    Bonferroni counts every pair as a test, but only tests pairs that can
+    pass the EF cutoff. Returns the tested pairs, their tables, and the
+    Bonferroni count.
+    """
+    bonferroni_count = None
+    if bonferroni:
+        bonferroni_count = len(efs.efs)
+        efs = select_pairs(efs, efs.efs >= ef_cutoff)
+    return efs, contingency_function(efs), bonferroni_count
+
+
+def chi2_contingencies(contingencies):
+    """Yates corrected chi-square tests for all 2x2 tables at once"""
+    # Follows stats.chi2_contingency step by step, so results match scipy
+    both, events, targets, neither = (contingencies.both, 
+        contingencies.events, contingencies.targets, contingencies.neither)
+    observed = np.array([both, events, targets, neither], dtype=np.float64)
+    rows = np.array([both + events, both + events, 
+                     targets + neither, targets + neither], dtype=np.float64)
+    cols = np.array([both + targets, events + neither, 
+                     both + targets, events + neither], dtype=np.float64)
+    total = (both + events + targets + neither).astype(np.float64)
+    expected = rows * cols / total
+    if np.any(expected == 0):
+        raise ScriptError("Contingency table has a zero expected frequency", 
+                          3)
+    diff = expected - observed
+    if YATES_CAPPED:
+        observed += np.minimum(0.5, np.abs(diff)) * np.sign(diff)
+    else:
+        observed += 0.5 * np.sign(diff)
+    chi2 = ((observed - expected)**2 / expected).sum(axis=0)
+    p_vals = stats.chi2.sf(chi2, 1)
+    return chi2, p_vals
+
+
+def log_choose(n, k):
+    """Log of the binomial coefficient, vectorized"""
+    return gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+
+
+def hypergeom_log_pmf(k, row, col, total):
+    """Log hypergeometric probability of k shared pairs, vectorized"""
+    return (log_choose(row, k) + log_choose(total - row, col - k) - 
+            log_choose(total, col))
+
+
+def hypergeom_tail_sum(k, last, row, col, total, step):
+    """Sum pmf(k + i*step)/pmf(k) until each tail reaches last or decays"""
+    other = total - row
+    tail = np.ones(len(k))
+    term = np.ones(len(k))
+    k = k.copy()
+    active = np.nonzero(k != last)[0]
+    while len(active):
+        ka, r, c, o = k[active], row[active], col[active], other[active]
+        if step > 0:
+            term[active] *= (r - ka) * (c - ka) / ((ka + 1) * (o - c + ka + 1))
+        else:
+            term[active] *= ka * (o - c + ka) / ((r - ka + 1) * (c - ka + 1))
+        tail[active] += term[active]
+        k[active] = ka + step
+        done = ((k[active] == last[active]) | 
+                (term[active] <= FISHER_TOLERANCE * tail[active]))
+        active = active[~done]
+    return tail
+
+
+def fisher_contingencies(contingencies):
+    """One-sided Fisher's exact tests for all 2x2 tables at once"""
+    # p = P(X >= both) with X ~ hypergeom(total, both+events, both+targets),
+    # the same as stats.fisher_exact(table, alternative="greater")
+    both = contingencies.both.astype(np.float64)
+    row = both + contingencies.events
+    col = both + contingencies.targets
+    total = row + contingencies.targets + contingencies.neither
+    k_min = np.maximum(0, col - (total - row))
+    k_max = np.minimum(row, col)
+    # Tail terms decay monotonically away from the mode
+    mode = np.floor((row + 1) * (col + 1) / (total + 2))
+    p_vals = np.ones(len(both))
+    # Above the mode, sum the upper tail directly in log space
+    up = np.nonzero(both > mode)[0]
+    k, r, c, n = both[up], row[up], col[up], total[up]
+    tail = hypergeom_tail_sum(k, k_max[up], r, c, n, 1)
+    p_vals[up] = np.exp(hypergeom_log_pmf(k, r, c, n) + np.log(tail))
+    # Otherwise, take the complement of the lower tail
+    down = np.nonzero((both <= mode) & (both > k_min))[0]
+    k, r, c, n = both[down] - 1, row[down], col[down], total[down]
+    tail = hypergeom_tail_sum(k, k_min[down], r, c, n, -1)
+    p_vals[down] = 1.0 - np.exp(hypergeom_log_pmf(k, r, c, n) + np.log(tail))
+    return np.clip(p_vals, 0.0, 1.0)
+
+
+def compute_p_values(contingencies, test="chi2", chunk_size=None):
+    """Compute p-values for every contingency table"""
+    if test == "fisher":
+        logging.info("Using one-sided Fisher's exact test for p-values")
+        test_function = fisher_contingencies
+    else:
+        logging.info("Using chi-square test for p-values")
+        test_function = lambda tables: chi2_contingencies(tables)[1]
+    num_tables = len(contingencies.both)
+    if not chunk_size or num_tables <= chunk_size:
+        return test_function(contingencies)
+    # Tests are independent per table, so chunks bound the temporaries
+    p_vals = np.empty(num_tables)
+    for start in xrange(0, num_tables, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        p_vals[chunk] = test_function(select_pairs(contingencies, chunk))
+    return p_vals
+
+
+def correct_p_values(p_vals, bonferroni_count=None, qvalue_method="holm", 
+                     max_sort_pairs=None):
+    """Compute q-values from the p-values of all tested pairs"""
     #Calculate the qvalue (p-adjusted FDR)
     if bonferroni_count:
         logging.info("Using Bonferroni correction for q-value calculations")
-        q_vals = [pval * float(bonferroni_count) for pval in p_vals]
+        q_vals = p_vals * float(bonferroni_count)
     else:
-        logging.info("Using Holm correction for q-value calculations")
-        reject_array, q_vals, alpha_c_sidak, alpha_c_bonf = multipletests(
-            p_vals, alpha=0.05, method='holm')
-    return target_event_pairs, p_vals, q_vals
+        if qvalue_method == "fdr_bh":
+            logging.info("Using Benjamini-Hochberg correction for q-value " 
+                         "calculations")
+        else:
+            logging.info("Using Holm correction for q-value calculations")
+        q_vals = adjust_pvalues(p_vals, method=qvalue_method, 
+                                max_in_memory=max_sort_pairs)
+    return q_vals
 
 
-def ef_analysis(events_reader, results_reader, min_pairs=CUTOFF_MINPAIRS, 
-                ef_cutoff=CUTOFF_EF, qvalue_cutoff=CUTOFF_QVALUE, 
-                bonferroni=False):
-    """Compute enrichment factors and write q-values."""
+def compute_q_values(contingencies, bonferroni_count=None, test="chi2", 
+                     qvalue_method="holm", max_sort_pairs=None, 
+                     chunk_size=None):
+    """Compute p and q-values"""
+    logging.info("Computing p and q-values")
+    p_vals = compute_p_values(contingencies, test=test, chunk_size=chunk_size)
+    q_vals = correct_p_values(p_vals, bonferroni_count=bonferroni_count, 
+                              qvalue_method=qvalue_method, 
+                              max_sort_pairs=max_sort_pairs)
+    return p_vals, q_vals
+
+
+def sparse_to_arrays(prefix, matrix):
+    """Flatten a CSR or CSC matrix into named arrays for an npz file"""
+    if matrix.format not in ("csr", "csc"):
+        matrix = matrix.tocsr()
+    return {prefix + "_data": matrix.data, prefix + "_indices": matrix.indices,
+            prefix + "_indptr": matrix.indptr, 
+            prefix + "_shape": np.array(matrix.shape), 
+            prefix + "_format": np.array(matrix.format)}
+
+
+def arrays_to_sparse(arrays, prefix):
+    """Rebuild a sparse matrix flattened by sparse_to_arrays"""
+    if str(arrays[prefix + "_format"]) == "csc":
+        matrix_type = sparse.csc_matrix
+    else:
+        matrix_type = sparse.csr_matrix
+    return matrix_type((arrays[prefix + "_data"], arrays[prefix + "_indices"], 
+                        arrays[prefix + "_indptr"]), 
+                       shape=tuple(arrays[prefix + "_shape"]))
+
+
+def file_content_hash(fn, block_size=1<<20):
+    """SHA1 hex digest of a file's contents"""
+    digest = hashlib.sha1()
+    in_f = open(fn, "rb")
+    try:
+        block = in_f.read(block_size)
+        while block:
+            digest.update(block)
+            block = in_f.read(block_size)
+    finally:
+        in_f.close()
+    return digest.hexdigest()
+
+
+def cached_file_hash(cache_dir, fn):
+    """Content hash of fn, only recomputed when its size or mtime change"""
+    index_fn = op.join(cache_dir, "file_hashes.json")
+    index = {}
+    if op.exists(index_fn):
+        index_f = open(index_fn, "r")
+        try:
+            index = json.load(index_f)
+        finally:
+            index_f.close()
+    path = op.realpath(fn)
+    info = os.stat(path)
+    entry = index.get(path)
+    if (entry and entry["size"] == info.st_size and 
+            entry["mtime"] == info.st_mtime):
+        return entry["sha1"]
+    logging.info("Hashing contents of %s" % fn)
+    content_hash = file_content_hash(path)
+    index[path] = {"size": info.st_size, "mtime": info.st_mtime, 
+                   "sha1": content_hash}
+    index_f = open(index_fn, "w")
+    try:
+        json.dump(index, index_f)
+    finally:
+        index_f.close()
+    return content_hash
+
+
+def incidence_cache_fn(cache_dir, events_fn, results_fn, shard=None, 
+                       prune_results=True):
+    """Cache file name keyed by both input files, the event shard, and 
+    whether result molecules without events were pruned"""
+    if not op.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    key = hashlib.sha1()
+    for fn in (events_fn, results_fn):
+        key.update(cached_file_hash(cache_dir, fn))
+    key.update(str(shard))
+    if not prune_results:
+        key.update("unpruned")
+    return op.join(cache_dir, "ef_incidence_%s.npz" % key.hexdigest()[:20])
+
+
+def write_incidence_cache(cache_fn, incidence, targets):
+    """Save pruned incidence matrices and target details as npz"""
+    logging.info("Writing incidence cache: %s" % cache_fn)
+    named_targets = sorted(targets)
+    arrays = {"drugs": np.array(incidence.drugs), 
+              "events": np.array(incidence.events), 
+              "targets": np.array(incidence.targets), 
+              "named_targets": np.array(named_targets), 
+              "target_names": np.array([targets[t].name for t in 
+                                        named_targets]), 
+              "target_descs": np.array([targets[t].description for t in 
+                                        named_targets])}
+    arrays.update(sparse_to_arrays("drug_events", incidence.drug_events))
+    arrays.update(sparse_to_arrays("drug_targets", incidence.drug_targets))
+    # Write to a temporary name, so readers never see a partial cache
+    tmp_fn = cache_fn + ".%d.tmp" % os.getpid()
+    cache_f = open(tmp_fn, "wb")
+    try:
+        np.savez_compressed(cache_f, **arrays)
+    finally:
+        cache_f.close()
+    os.rename(tmp_fn, cache_fn)
+
+
+def read_incidence_cache(cache_fn):
+    """Load incidence matrices and target details saved as npz"""
+    logging.info("Reading incidence cache: %s" % cache_fn)
+    arrays = np.load(cache_fn)
+    try:
+        targets = dict((tid, Target(name, desc)) for tid, name, desc in 
+                       zip(arrays["named_targets"].tolist(), 
+                           arrays["target_names"].tolist(), 
+                           arrays["target_descs"].tolist()))
+        incidence = Incidence(arrays["drugs"].tolist(), 
+                              arrays["events"].tolist(), 
+                              arrays["targets"].tolist(), 
+                              arrays_to_sparse(arrays, "drug_events"), 
+                              arrays_to_sparse(arrays, "drug_targets"))
+    finally:
+        arrays.close()
+    logging.info("Loaded %d drug-event and %d drug-target pairs for %d " 
+                 "targets" % (incidence.drug_events.nnz, 
+                 incidence.drug_targets.nnz, len(targets)))
+    return incidence, targets
+
+
+def read_incidence(events_reader, results_reader, vocabulary=None, 
+                   shard=None, cache_fn=None, prune_results=True):
+    """Read, intern, and prune events and results into sparse incidence
+
+    Without prune_results, result molecules that are not mapped to events 
+    keep their drug-target rows, though they still link no events.
+    """
+    if cache_fn and op.exists(cache_fn):
+        return read_incidence_cache(cache_fn)
+    if vocabulary is None:
+        vocabulary = new_vocabulary()
+    event_edges, has_event = read_event_codes(events_reader, vocabulary, 
+                                              shard=shard)
+    if prune_results:
+        target_edges, has_target, targets = read_result_codes(
+            results_reader, vocabulary, has_event)
+    else:
+        target_edges, has_target, targets = read_result_codes(
+            results_reader, vocabulary)
+        has_event = np.concatenate([has_event, np.zeros(
+            len(has_target) - len(has_event), dtype=bool)])
+    incidence = build_incidence(vocabulary, event_edges, target_edges, 
+                                has_event, has_target)
+    if cache_fn:
+        write_incidence_cache(cache_fn, incidence, targets)
+    return incidence, targets
+
+
+def validate_options(test="chi2", qvalue_method="holm"):
+    """Reject unknown significance tests and q-value methods"""
+    if test not in TESTS:
+        raise ScriptError("Unknown significance test: %s" % test, 2)
+    if qvalue_method not in METHODS:
+        raise ScriptError("Unknown q-value method: %s" % qvalue_method, 2)
+
+
+def log_cutoffs(min_pairs, ef_cutoff, qvalue_cutoff):
+    """Log the cutoffs of one EF run"""
     logging.info("Using min-pairs cutoff = %d" % min_pairs)
     logging.info("Using EF cutoff = %.2f" % ef_cutoff)
     logging.info("Using q-value cutoff = %g" % qvalue_cutoff)
-    events_to_drugs, has_event = read_events(events_reader)
-    targets_to_drugs, has_target, targets = read_results(results_reader, 
-                                                             has_event)
-    events_to_drugs = prune_events(events_to_drugs, has_event, has_target)
-    del has_target, has_event
-    E, T = precompute_sums(events_to_drugs, targets_to_drugs)
-    efs = compute_efs(E, T, events_to_drugs, targets_to_drugs, 
-                      min_pairs=min_pairs, ef_cutoff=ef_cutoff)
-    bonferroni_count = None
-    if bonferroni:
-        bonferroni_count = len(efs)
-        efs = dict((k, v) for k, v in efs.iteritems() if v >= ef_cutoff)
-    contingencies = map_contingency_tables(efs, events_to_drugs, 
-                                           targets_to_drugs)
-    target_event_pairs, p_vals, q_vals = compute_q_values(contingencies, 
-                                                          bonferroni_count)
-    assert(len(target_event_pairs) == len(efs))
+
+
+def ef_analysis(events_reader, results_reader, min_pairs=CUTOFF_MINPAIRS, 
+                ef_cutoff=CUTOFF_EF, qvalue_cutoff=CUTOFF_QVALUE, 
+                bonferroni=False, engine="sparse", test="chi2", 
+                qvalue_method="holm", max_sort_pairs=None, jobs=1, 
+                vocabulary=None, cache_fn=None, bootstrap=None, 
+                null_clusters=None, random_seed=SAMPLE_SEED):
+    """Compute enrichment factors and write q-values."""
+    if engine not in ENGINES:
+        raise ScriptError("Unknown EF engine: %s" % engine, 2)
+    if bootstrap and engine != "sparse":
+        raise ScriptError("Bootstrap intervals require the sparse EF " 
+                          "engine", 2)
+    if null_clusters and engine != "sparse":
+        raise ScriptError("Empirical nulls require the sparse EF engine", 2)
+    validate_options(test=test, qvalue_method=qvalue_method)
+    if jobs > 1 and engine != "sparse":
+        raise ScriptError("Parallel jobs require the sparse EF engine", 2)
+    logging.info("Using %s EF engine" % engine)
+    log_cutoffs(min_pairs, ef_cutoff, qvalue_cutoff)
+    timer = StageTimer(workers=jobs > 1)
+    if engine == "sparse":
+        incidence, targets = read_incidence(events_reader, results_reader, 
+                                            vocabulary=vocabulary, 
+                                            cache_fn=cache_fn)
+        incidence = collapse_incidence(incidence)
+        timer("input")
+        event_names, target_names = incidence.events, incidence.targets
+        efs = compute_efs_sparse(incidence, min_pairs=min_pairs, jobs=jobs)
+    else:
+        # Original set intersection engine, kept as a reference
+        events_to_drugs, targets_to_drugs, targets = read_pruned_sets(
+            events_reader, results_reader)
+        timer("input")
+        E, T = precompute_sums(events_to_drugs, targets_to_drugs)
+        efs = compute_efs(E, T, events_to_drugs, targets_to_drugs, 
+                          min_pairs=min_pairs, ef_cutoff=ef_cutoff)
+        efs, event_names, target_names = efs_dict_to_table(efs, 
+            events_to_drugs, targets_to_drugs)
+    timer("enrichment factors")
+    if engine == "sparse":
+        contingency_function = lambda efs: map_contingency_tables_sparse(
+            efs, incidence)
+    else:
+        contingency_function = lambda efs: map_contingency_tables(efs, 
+            events_to_drugs, targets_to_drugs, event_names, target_names)
+    efs, contingencies, bonferroni_count = tested_contingencies(efs, 
+        contingency_function, bonferroni=bonferroni, ef_cutoff=ef_cutoff)
+    timer("contingency tables")
+    column_functions = []
+    if bootstrap:
+        column_functions.append(lambda passed: bootstrap_columns(incidence, 
+            efs, passed, bootstrap, random_seed=random_seed, timer=timer))
+    if null_clusters:
+        column_functions.append(lambda passed: null_columns(incidence, efs, 
+            passed, null_clusters, min_pairs=min_pairs, 
+            random_seed=random_seed, timer=timer))
+    extra_columns = ()
+    if column_functions:
+        extra_columns = lambda passed: sum([f(passed) for f in 
+                                            column_functions], [])
+    for row in ef_results(efs, contingencies, event_names, target_names, 
+                          targets, ef_cutoff=ef_cutoff, 
+                          qvalue_cutoff=qvalue_cutoff, 
+                          bonferroni_count=bonferroni_count, test=test, 
+                          qvalue_method=qvalue_method, 
+                          max_sort_pairs=max_sort_pairs, timer=timer, 
+                          extra_columns=extra_columns):
+        yield row
+
+
+def ef_results(efs, contingencies, event_names, target_names, targets, 
+               ef_cutoff=CUTOFF_EF, qvalue_cutoff=CUTOFF_QVALUE, 
+               bonferroni_count=None, test="chi2", qvalue_method="holm", 
+               max_sort_pairs=None, timer=None, chunk_size=None, 
+               extra_columns=()):
+    """Compute p and q-values and yield the output rows"""
+    if timer is None:
+        timer = StageTimer()
+    p_vals, q_vals = compute_q_values(contingencies, bonferroni_count, 
+                                      test=test, qvalue_method=qvalue_method, 
+                                      max_sort_pairs=max_sort_pairs, 
+                                      chunk_size=chunk_size)
+    assert(len(p_vals) == len(efs.efs))
+    timer("p and q-values")
+    for row in format_results(efs, p_vals, q_vals, event_names, 
+                              target_names, targets, ef_cutoff=ef_cutoff, 
+                              qvalue_cutoff=qvalue_cutoff, 
+                              extra_columns=extra_columns):
+        yield row
+    timer("output")
+
+
+def format_value(value):
+    """Format an extra output value, keeping strings as they are"""
+    if isinstance(value, basestring):
+        return value
+    return "%.5g" % value
+
+
+def format_results(efs, p_vals, q_vals, event_names, target_names, targets, 
+                   ef_cutoff=CUTOFF_EF, qvalue_cutoff=CUTOFF_QVALUE, 
+                   extra_columns=()):
+    """Yield output rows for pairs passing the EF and q-value cutoffs"""
+    # Strings are only restored from their codes for the written pairs
+    passed = np.nonzero((efs.efs > ef_cutoff) & (q_vals < qvalue_cutoff))[0]
+    if callable(extra_columns):
+        # Deferred columns are only computed for the written pairs
+        extra_columns = extra_columns(passed)
     logging.info("Writing output")
-    yield ["uniprot_id", "targ_name", "event", "ef", "p-value", "q-value"]
-    count = 0
-    for te_pair, p_val, q_val in zip(target_event_pairs, p_vals, q_vals):
-        target, event = te_pair
-        if efs[te_pair] > ef_cutoff and q_val < qvalue_cutoff:
-            count += 1
-            yield [target, targets[target].name, event, "%.5g" % efs[te_pair],
-                   "%.5g" % p_val, "%.5g" % q_val]
-    logging.info("Wrote %d q-values to output" % count)
-
-
-def handler(events_fn, results_fn, out_fn, **kwargs):
+    yield ["uniprot_id", "targ_name", "event", "ef", "p-value", "q-value"] + \
+          [name for name, values in extra_columns]
+    for i in passed:
+        target = target_names[efs.targets[i]]
+        event = event_names[efs.events[i]]
+        yield [target, targets[target].name, event, "%.5g" % efs.efs[i], 
+               "%.5g" % p_vals[i], "%.5g" % q_vals[i]] + \
+              [format_value(values[i]) for name, values in extra_columns]
+    logging.info("Wrote %d q-values to output" % len(passed))
+
+
+def ef_sweep(events_reader, results_reader, min_pairs=(CUTOFF_MINPAIRS,), 
+             ef_cutoff=(CUTOFF_EF,), qvalue_cutoff=(CUTOFF_QVALUE,), 
+             bonferroni=False, test="chi2", qvalue_method="holm", 
+             max_sort_pairs=None, jobs=1, vocabulary=None, cache_fn=None):
+    """Compute EFs once and yield (cutoffs, row) for every combination"""
+    validate_options(test=test, qvalue_method=qvalue_method)
+    min_pairs_list = sorted(set(min_pairs))
+    logging.info("Sweeping min-pairs cutoffs = %s" % min_pairs_list)
+    logging.info("Sweeping EF cutoffs = %s" % list(ef_cutoff))
+    logging.info("Sweeping q-value cutoffs = %s" % list(qvalue_cutoff))
+    incidence, targets = read_incidence(events_reader, results_reader, 
+                                        vocabulary=vocabulary, 
+                                        cache_fn=cache_fn)
+    incidence = collapse_incidence(incidence)
+    # Pair counts, EFs, and p-values do not depend on the cutoffs, so 
+    # compute them once at the lowest min-pairs cutoff
+    all_efs = compute_efs_sparse(incidence, min_pairs=min_pairs_list[0], 
+                                 jobs=jobs)
+    contingencies = map_contingency_tables_sparse(all_efs, incidence)
+    logging.info("Computing p-values")
+    all_p_vals = compute_p_values(contingencies, test=test)
+    del contingencies
+    previous_count = None
+    for pairs_cutoff in min_pairs_list:
+        tested = all_efs.pairs >= pairs_cutoff
+        count = int(tested.sum())
+        # Nested tested sets only differ when their sizes differ
+        if count != previous_count:
+            efs = select_pairs(all_efs, tested)
+            p_vals = all_p_vals[tested]
+            logging.info("Computing q-values for %d pairs at min-pairs " 
+                         "cutoff = %d" % (count, pairs_cutoff))
+            bonferroni_count = count if bonferroni else None
+            q_vals = correct_p_values(p_vals, 
+                                      bonferroni_count=bonferroni_count, 
+                                      qvalue_method=qvalue_method, 
+                                      max_sort_pairs=max_sort_pairs)
+            previous_count = count
+        for ef_value in ef_cutoff:
+            for qvalue_value in qvalue_cutoff:
+                cutoffs = (pairs_cutoff, ef_value, qvalue_value)
+                for row in format_results(efs, p_vals, q_vals, 
+                                          incidence.events, 
+                                          incidence.targets, targets, 
+                                          ef_cutoff=ef_value, 
+                                          qvalue_cutoff=qvalue_value):
+                    yield cutoffs, row
+
+
+def scan_events(events_reader, sample_events=PLAN_SAMPLE_EVENTS):
+    """Count event rows and per molecule degrees in one streaming pass, 
+    keeping the molecules of a uniform sample of events"""
+    logging.info("Scanning events")
+    num_rows = 0
+    event_degrees = Counter()
+    event_ids = set()
+    # Events with the smallest ID hashes form the sample, so membership 
+    # is decided as each event first appears, without a second pass
+    heap = []
+    sampled = {}
+    for row in events_reader:
+        cid, eid = row[:2]
+        num_rows += 1
+        if eid in sampled:
+            if cid not in sampled[eid]:
+                sampled[eid].add(cid)
+                event_degrees[cid] += 1
+            continue
+        event_degrees[cid] += 1
+        if eid in event_ids:
+            continue
+        event_ids.add(eid)
+        key = zlib.crc32(eid) & 0xffffffff
+        if len(heap) < sample_events:
+            heapq.heappush(heap, (-key, eid))
+        elif key < -heap[0][0]:
+            del sampled[heapq.heapreplace(heap, (-key, eid))[1]]
+        else:
+            continue
+        sampled[eid] = set([cid])
+    logging.info("Scanned %d events over %d molecules" % (len(event_ids), 
+                                                           len(event_degrees)))
+    return num_rows, len(event_ids), event_degrees, sampled
+
+
+def fold_links(keys, counts, link_targets, link_events, num_sampled):
+    """Fold buffered target-event links into sorted distinct pair keys 
+    with their shared molecule counts, emptying the buffers"""
+    new_keys = np.frombuffer(link_targets, dtype=np.int32).astype(np.int64) * \
+               max(num_sampled, 1) + np.frombuffer(link_events, dtype=np.int32)
+    del link_targets[:], link_events[:]
+    keys = np.concatenate([keys, new_keys])
+    counts = np.concatenate([counts, np.ones(len(new_keys), dtype=np.int64)])
+    if not len(keys):
+        return keys, counts
+    order = np.argsort(keys, kind="mergesort")
+    keys, counts = keys[order], counts[order]
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(keys)) + 1])
+    return keys[starts], np.add.reduceat(counts, starts)
+
+
+def scan_results(results_reader, event_degrees, sampled):
+    """Count SEAware result rows and per molecule target degrees in one 
+    streaming pass, with target counts for the sampled events"""
+    logging.info("Scanning targets")
+    header = results_reader.next()
+    logging.info("Skipping SEAware results header: %s" % str(header))
+    num_rows = 0
+    target_degrees = Counter()
+    target_ids = Interner()
+    sample_events = defaultdict(list)
+    for slot, cids in enumerate(sampled.itervalues()):
+        for cid in cids:
+            sample_events[cid].append(slot)
+    # Links of sampled events to targets, buffered as interned code pairs 
+    # and folded into per pair counts in blocks
+    link_targets = array("i")
+    link_events = array("i")
+    keys = np.zeros(0, dtype=np.int64)
+    sample_counts = np.zeros(0, dtype=np.int64)
+    # SEAware writes each target's rows together, so dropping repeats 
+    # within a run of one target takes the union over affinity groups
+    run_tid, run_cids = None, set()
+    for row in results_reader:
+        cid, tid = row[0], row[2]
+        num_rows += 1
+        if cid not in event_degrees:
+            continue
+        if tid != run_tid:
+            run_tid, run_cids = tid, set()
+        if cid in run_cids:
+            continue
+        run_cids.add(cid)
+        target_degrees[cid] += 1
+        target = target_ids.intern(tid)
+        for slot in sample_events.get(cid, ()):
+            link_targets.append(target)
+            link_events.append(slot)
+        if len(link_targets) >= PLAN_LINK_BLOCK:
+            keys, sample_counts = fold_links(keys, sample_counts, 
+                link_targets, link_events, len(sampled))
+    keys, sample_counts = fold_links(keys, sample_counts, link_targets, 
+                                     link_events, len(sampled))
+    logging.info("Scanned %d targets over %d molecules" % (
+        len(target_ids), len(target_degrees)))
+    return num_rows, len(target_ids), target_degrees, sample_counts
+
+
+def estimate_resources(sizes, jobs=1, test="chi2"):
+    """Estimate peak memory and runtime of each engine from problem sizes"""
+    costs = PLAN_COSTS
+    read_time = (sizes["event_rows"] + sizes["result_rows"]) * \
+                costs["read_row_seconds"]
+    pairs = sizes["candidate_pairs"]
+    test_time = pairs * (costs["test_pair_seconds"][test] + 
+                         costs["output_pair_seconds"])
+    # Only the pair count product is split across jobs
+    sparse_time = (read_time + test_time + 
+                   pairs * costs["sparse_pair_seconds"] + 
+                   sizes["pair_products"] * costs["product_flop_seconds"] * 
+                   (0.5 + 0.5 / jobs))
+    sparse_bytes = (costs["base_bytes"] + 
+                    (sizes["event_rows"] + sizes["result_rows"]) * 
+                    costs["sparse_row_bytes"] + 
+                    sizes["target_event_pairs"] * 
+                    costs["sparse_product_bytes"] + 
+                    pairs * costs["sparse_pair_bytes"])
+    # Sets engine intersects every linked event with every target
+    links = sizes["drug_event_pairs"] + sizes["drug_target_pairs"]
+    event_size = sizes["drug_event_pairs"] / max(sizes["linked_events"], 1.0)
+    target_size = sizes["drug_target_pairs"] / max(sizes["targets"], 1.0)
+    sets_time = (read_time + test_time + 
+                 sizes["linked_events"] * sizes["targets"] * 
+                 min(event_size, target_size) * costs["sets_probe_seconds"] + 
+                 pairs * (event_size + target_size) * 
+                 costs["sets_link_seconds"])
+    sets_bytes = (costs["base_bytes"] + links * costs["sets_link_bytes"] + 
+                  pairs * costs["sets_pair_bytes"])
+    return {"sparse": {"peak_memory_mb": round(sparse_bytes / 2**20, 1), 
+                       "runtime_seconds": round(sparse_time, 1)}, 
+            "sets": {"peak_memory_mb": round(sets_bytes / 2**20, 1), 
+                     "runtime_seconds": round(sets_time, 1)}}
+
+
+def ef_plan(events_reader, results_reader, min_pairs=CUTOFF_MINPAIRS, 
+            jobs=1, test="chi2", sample_events=PLAN_SAMPLE_EVENTS):
+    """Measure problem size and estimate resources without computing EFs"""
+    validate_options(test=test)
+    # Streams the ID columns only, so planning never builds the incidence
+    event_rows, num_events, event_degrees, sampled = scan_events(
+        events_reader, sample_events)
+    result_rows, num_targets, target_degrees, sample_counts = scan_results(
+        results_reader, event_degrees, sampled)
+    # Pair counts are independent per event, so count pairs over a sample 
+    # of events and scale up, keeping the plan cheap for huge inputs
+    logging.info("Scaling pair counts from %d sampled events" % len(sampled))
+    scale = float(num_events) / max(len(sampled), 1)
+    linked_events = int(round(scale * sum(
+        1 for cids in sampled.itervalues() if 
+        any(cid in target_degrees for cid in cids))))
+    if min_pairs > 0:
+        candidate_pairs = (sample_counts >= min_pairs).sum() * scale
+    else:
+        candidate_pairs = linked_events * num_targets
+    sizes = {"events": num_events, "linked_events": linked_events, 
+             "targets": num_targets, 
+             "molecules": len(target_degrees), 
+             "event_rows": event_rows, 
+             "result_rows": result_rows, 
+             "drug_event_pairs": sum(event_degrees[cid] for cid in 
+                                     target_degrees), 
+             "drug_target_pairs": sum(target_degrees.itervalues()), 
+             "pair_products": sum(event_degrees[cid] * degree for cid, 
+                                  degree in target_degrees.iteritems()), 
+             "sampled_events": len(sampled), 
+             "target_event_pairs": int(round(len(sample_counts) * scale)), 
+             "candidate_pairs": int(round(candidate_pairs))}
+    plan = {"min_pairs": min_pairs, "jobs": jobs, "test": test}
+    plan.update(sizes)
+    plan["engines"] = estimate_resources(sizes, jobs=jobs, test=test)
+    for engine in ENGINES:
+        logging.info("Estimated %s engine peak memory %.1f MB and runtime " 
+                     "%.1f s" % (engine, plan["engines"][engine]
+                     ["peak_memory_mb"], plan["engines"][engine]
+                     ["runtime_seconds"]))
+    return plan
+
+
+def target_partition(tid, num_partitions):
+    """Hash a target ID into one of num_partitions partitions"""
+    return (zlib.crc32(tid) & 0xffffffff) % num_partitions
+
+
+def partition_results(results_reader, vocabulary, event_degrees, 
+                      num_partitions, work_dir):
+    """Stream SEAware results into per-target hash partitions on disk"""
+    logging.info("Partitioning targets into %d temporary files" % 
+                 num_partitions)
+    header = results_reader.next()
+    logging.info("Skipping SEAware results header: %s" % str(header))
+    molecules = vocabulary["molecule"]
+    target_ids = vocabulary["target"]
+    targets = {}
+    # Partitions by target code, which a read vocabulary may already assign
+    target_parts = {}
+    has_target = np.zeros(len(molecules), dtype=bool)
+    # Estimated in-memory bytes for each partition's pair counts
+    partition_bytes = np.zeros(num_partitions, dtype=np.int64)
+    rejects = 0
+    partition_fns = [op.join(work_dir, "targets_%04d.bin" % i) for i in 
+                     xrange(num_partitions)]
+    buffers = [array("i") for i in xrange(num_partitions)]
+    partition_files = [open(fn, "wb") for fn in partition_fns]
+    try:
+        for row in results_reader:
+            cid, smiles, tid, affinity, pvalue, maxtc, name, desc = row
+            code = molecules.get(cid)
+            if code is None or not event_degrees[code]:
+                rejects += 1
+                continue
+            target = target_ids.intern(tid)
+            if tid not in targets:
+                targets[tid] = Target(name, desc)
+                target_parts[target] = target_partition(tid, num_partitions)
+            has_target[code] = True
+            # Buffer drug and target code pairs, flushing in small blocks
+            part = target_parts[target]
+            partition_bytes[part] += (PARTITION_PAIR_BYTES + 
+                                      PARTITION_FLOP_BYTES * 
+                                      event_degrees[code])
+            buffers[part].append(code)
+            buffers[part].append(target)
+            if len(buffers[part]) >= PARTITION_BUFFER:
+                buffers[part].tofile(partition_files[part])
+                del buffers[part][:]
+        for buf, partition_f in zip(buffers, partition_files):
+            buf.tofile(partition_f)
+    finally:
+        for partition_f in partition_files:
+            partition_f.close()
+    logging.info("Skipped %d SEAware result rows for molecules that were " 
+                 "not mapped to events" % rejects)
+    logging.info("Mapped %d targets to %d molecules" % (
+        len(targets), has_target.sum()))
+    return partition_fns, partition_bytes, has_target, targets
+
+
+def partition_blocks(partition_fns, partition_bytes, budget):
+    """Group partition files into blocks that fit in a memory budget"""
+    blocks = []
+    block, block_bytes = [], 0
+    oversized = 0
+    for fn, size in zip(partition_fns, partition_bytes):
+        if block and block_bytes + size > budget:
+            blocks.append(block)
+            block, block_bytes = [], 0
+        oversized += size > budget
+        block.append(fn)
+        block_bytes += size
+    if block:
+        blocks.append(block)
+    if oversized:
+        logging.warn("%d target partitions alone exceed the %.1f MB block " 
+                     "budget" % (oversized, budget / 2.0**20))
+    return blocks
+
+
+def read_partition_block(block, shape):
+    """Load one block of partitions as a sparse drug x target matrix"""
+    codes = np.concatenate([np.fromfile(fn, dtype=np.int32) for fn in block])
+    codes = codes.reshape(-1, 2)
+    # Duplicate affinity rows are reset to single links
+    return edges_to_matrix(codes[:, 0], codes[:, 1], shape)
+
+
+def partition_contingencies(efs, blocks, shape, drug_events, target_counts):
+    """Contingency tables for the EF pairs from a pass over the partitions"""
+    # Contingency sums need every drug's full target count, so they wait
+    # for a second pass over the partitions
+    logging.info("Computing contingency tables")
+    events_drugs = drug_events.T.tocsr()
+    target_sums = np.zeros(shape[1], dtype=np.int64)
+    both = np.zeros(len(efs.efs), dtype=np.int64)
+    weights = sparse.diags(target_counts, 0)
+    for block in blocks:
+        drug_targets = read_partition_block(block, shape)
+        target_sums += drug_targets.T.dot(target_counts)
+        in_block = np.diff(drug_targets.indptr) > 0
+        selected = np.nonzero(in_block[efs.targets])[0]
+        if len(selected):
+            weighted = weights.dot(drug_targets).tocsc()
+            both_block = events_drugs.dot(weighted).tocsr()
+            both[selected] = np.asarray(both_block[
+                efs.events[selected], efs.targets[selected]]).ravel()
+        del drug_targets
+    sums = ContingencySums(both, drug_events.T.dot(target_counts),
+                           target_sums, int(target_counts.sum()))
+    return contingencies_from_sums(efs, sums)
+
+
+def ef_out_of_core(events_reader, results_reader, memory_limit,
+                   results_size=None, min_pairs=CUTOFF_MINPAIRS,
+                   ef_cutoff=CUTOFF_EF, qvalue_cutoff=CUTOFF_QVALUE,
+                   bonferroni=False, engine="sparse", test="chi2",
+                   qvalue_method="holm", max_sort_pairs=None, jobs=1,
+                   vocabulary=None, tmp_dir=None):
+    """Compute EFs and q-values with target partitions spilled to disk."""
+    if engine != "sparse" or jobs > 1:
+        raise ScriptError("Out-of-core mode requires the sparse EF engine " 
+                          "in a single process", 2)
+    validate_options(test=test, qvalue_method=qvalue_method)
+    logging.info("Using out-of-core mode with memory limit = %d MB" % 
+                 memory_limit)
+    log_cutoffs(min_pairs, ef_cutoff, qvalue_cutoff)
+    limit_bytes = memory_limit * 2**20
+    if max_sort_pairs is None:
+        max_sort_pairs = max(1, limit_bytes // SORT_PAIR_BYTES)
+    timer = StageTimer()
+    if vocabulary is None:
+        vocabulary = new_vocabulary()
+    event_edges, has_event = read_event_codes(events_reader, vocabulary)
+    event_degrees = np.bincount(event_edges[0], 
+                                minlength=len(vocabulary["molecule"]))
+    # Aim for partitions well under the limit, later grouped into blocks
+    num_partitions = MIN_PARTITIONS
+    if results_size:
+        num_partitions = int(min(MAX_PARTITIONS, max(MIN_PARTITIONS, 
+            np.ceil(16.0 * results_size / limit_bytes))))
+    work_dir = tempfile.mkdtemp(prefix="ef_partitions_", dir=tmp_dir)
+    try:
+        partition_fns, partition_bytes, has_target, targets = \
+            partition_results(results_reader, vocabulary, event_degrees, 
+                              num_partitions, work_dir)
+        keep = has_target[event_edges[0]]
+        logging.info("Pruned %d event molecules that were not mapped to " 
+                     "targets" % (has_event & ~has_target).sum())
+        num_drugs = len(vocabulary["molecule"])
+        event_names = vocabulary["event"].names
+        target_names = vocabulary["target"].names
+        drug_events = edges_to_matrix(event_edges[0][keep], 
+                                      event_edges[1][keep], 
+                                      (num_drugs, len(event_names)))
+        del event_edges, keep
+        events_drugs = drug_events.T.tocsr()
+        timer("input")
+        # Blocks get whatever memory the event incidence leaves over
+        budget = limit_bytes - peak_rss_mb() * 2**20
+        if budget < limit_bytes / 8:
+            logging.warn("Memory limit leaves little room beyond the %.1f MB " 
+                         "already in use" % peak_rss_mb())
+            budget = limit_bytes / 8
+        blocks = partition_blocks(partition_fns, partition_bytes, budget)
+        logging.info("Processing %d partition blocks" % len(blocks))
+        shape = (num_drugs, len(target_names))
+        linked = np.nonzero(np.diff(drug_events.indptr) > 0)[0]
+        E = np.zeros(len(event_names), dtype=np.int64)
+        T = np.zeros(len(target_names), dtype=np.int64)
+        P = 0
+        target_counts = np.zeros(num_drugs, dtype=np.int64)
+        pair_parts = []
+        for block in blocks:
+            drug_targets = read_partition_block(block, shape)
+            # Each target lives in one partition, so T is complete per block
+            target_counts += np.diff(drug_targets.tocsr().indptr)
+            pair_counts = events_drugs.dot(drug_targets.tocsc()).tocsr()
+            E += np.asarray(pair_counts.sum(axis=1), dtype=np.int64).ravel()
+            T += np.asarray(pair_counts.sum(axis=0), dtype=np.int64).ravel()
+            P += int(pair_counts.sum())
+            if min_pairs > 0:
+                coo = pair_counts.tocoo()
+                passed = coo.data >= min_pairs
+                pair_parts.append((coo.row[passed], coo.col[passed], 
+                                   coo.data[passed]))
+            else:
+                block_targets = np.nonzero(np.diff(drug_targets.indptr))[0]
+                rows = np.repeat(linked, len(block_targets))
+                cols = np.tile(block_targets, len(linked))
+                pte = np.zeros(len(rows), dtype=np.int64)
+                if len(rows):
+                    pte[:] = np.asarray(pair_counts[rows, cols]).ravel()
+                pair_parts.append((rows, cols, pte))
+            del drug_targets, pair_counts
+        del events_drugs
+        rows, cols, pte = [np.concatenate(x) for x in zip(*pair_parts)]
+        del pair_parts
+        # Sort pairs, so output does not depend on the partitioning
+        order = np.lexsort((cols, rows))
+        rows, cols, pte = rows[order], cols[order], pte[order]
+        efs = pte.astype(np.float64) / (E[rows] * T[cols])
+        efs = efs * P
+        logging.info("Computed %d target-event enrichment factors" % 
+                     len(efs))
+        efs = EFTable(rows, cols, pte, efs)
+        timer("enrichment factors")
+        efs, contingencies, bonferroni_count = tested_contingencies(efs,
+            lambda efs: partition_contingencies(efs, blocks, shape,
+                                                drug_events, target_counts),
+            bonferroni=bonferroni, ef_cutoff=ef_cutoff)
+        timer("contingency tables")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    for row in ef_results(efs, contingencies, event_names, target_names, 
+                          targets, ef_cutoff=ef_cutoff, 
+                          qvalue_cutoff=qvalue_cutoff, 
+                          bonferroni_count=bonferroni_count, test=test, 
+                          qvalue_method=qvalue_method, 
+                          max_sort_pairs=max_sort_pairs, timer=timer, 
+                          chunk_size=max(1, limit_bytes // TEST_PAIR_BYTES)):
+        yield row
+
+
+def incidence_weights(incidence):
+    """Molecule count behind each incidence row"""
+    if incidence.weights is None:
+        return np.ones(incidence.drug_events.shape[0], dtype=np.int64)
+    return incidence.weights
+
+
+def incidence_margins(incidence):
+    """Exact E, T, P, and weighted target counts from molecule degrees"""
+    weights = incidence_weights(incidence)
+    event_counts = np.diff(incidence.drug_events.tocsr().indptr) * weights
+    target_counts = np.diff(incidence.drug_targets.tocsr().indptr) * weights
+    # Each molecule adds its targets to each of its events, and vice versa
+    E = incidence.drug_events.T.dot(target_counts)
+    T = incidence.drug_targets.T.dot(event_counts)
+    P = int((event_counts * np.diff(
+        incidence.drug_targets.tocsr().indptr)).sum())
+    return E, T, P, target_counts
+
+
+def pair_sums(incidence, rows, cols, drug_weights):
+    """Sum drug weights over the molecules each event-target pair shares"""
+    drug_events = incidence.drug_events.tocsc()
+    drug_targets = sparse.diags(drug_weights, 0).dot(
+        incidence.drug_targets).tocsc()
+    sums = np.zeros(len(rows), dtype=np.int64)
+    # Only events holding requested pairs enter the product, a chunk at a time
+    events = np.unique(rows)
+    for start in xrange(0, len(events), EVENT_CHUNK):
+        chunk = events[start:start+EVENT_CHUNK]
+        selected = np.nonzero((rows >= chunk[0]) & (rows <= chunk[-1]))[0]
+        products = drug_events[:, chunk].T.tocsr().dot(drug_targets).tocsr()
+        sums[selected] = np.asarray(products[
+            np.searchsorted(chunk, rows[selected]), cols[selected]]).ravel()
+    return sums
+
+
+def pair_contingencies(efs, incidence):
+    """Contingency tables for just the EF pairs, without the full product"""
+    logging.info("Computing contingency tables")
+    E, T, P, target_counts = incidence_margins(incidence)
+    both = pair_sums(incidence, efs.events, efs.targets, target_counts)
+    sums = ContingencySums(both, E, 
+                           incidence.drug_targets.T.dot(target_counts), 
+                           int(target_counts.sum()))
+    return contingencies_from_sums(efs, sums)
+
+
+def pair_keys(pair_counts):
+    """Sorted event-target pair keys and counts of a sparse pair matrix"""
+    pair_counts = pair_counts.tocsr()
+    pair_counts.sort_indices()
+    coo = pair_counts.tocoo()
+    keys = coo.row.astype(np.int64) * pair_counts.shape[1] + coo.col
+    return keys, coo.data
+
+
+def lookup_keys(keys, values, query):
+    """Look up values for query keys in sorted keys, zero when missing"""
+    found = np.zeros(len(query), dtype=values.dtype)
+    if len(keys):
+        positions = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+        hits = keys[positions] == query
+        found[hits] = values[positions[hits]]
+    return found
+
+
+def sample_worker(task):
+    """Compute pair counts, E, T, and P for one seeded molecule subsample"""
+    seed, fraction = task
+    incidence = _worker_incidence
+    # Weighted rows draw how many of their molecules are sampled
+    weights = np.random.RandomState(seed).binomial(
+        incidence_weights(incidence), fraction)
+    sampled = np.nonzero(weights)[0]
+    return compute_pair_counts(Incidence(
+        None, incidence.events, incidence.targets, 
+        incidence.drug_events.tocsr()[sampled].tocsc(), 
+        incidence.drug_targets.tocsr()[sampled].tocsc(), 
+        weights[sampled].astype(np.int64)))
+
+
+def sample_pair_counts(incidence, fraction, repeats, random_seed, jobs=1):
+    """Pair counts for repeated subsamples, run across a process pool"""
+    global _worker_incidence
+    # Seeds follow the repeat, so results do not depend on jobs
+    tasks = [(random_seed + i, fraction) for i in xrange(repeats)]
+    logging.info("Computing pair counts for %d subsamples of %g of the " 
+                 "molecules with %d jobs" % (repeats, fraction, jobs))
+    _worker_incidence = incidence
+    try:
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                samples = pool.map(sample_worker, tasks)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            samples = [sample_worker(task) for task in tasks]
+    finally:
+        _worker_incidence = None
+    return samples
+
+
+def ef_subsample(events_reader, results_reader, sample_fraction, 
+                 sample_repeats=SAMPLE_REPEATS, random_seed=SAMPLE_SEED, 
+                 min_pairs=CUTOFF_MINPAIRS, ef_cutoff=CUTOFF_EF, 
+                 qvalue_cutoff=CUTOFF_QVALUE, bonferroni=False, 
+                 engine="sparse", test="chi2", qvalue_method="holm", 
+                 max_sort_pairs=None, jobs=1, vocabulary=None, cache_fn=None):
+    """Screen pairs with subsampled counts, then compute exact q-values."""
+    if engine != "sparse":
+        raise ScriptError("Subsampling requires the sparse EF engine", 2)
+    if not 0 < sample_fraction <= 1:
+        raise ScriptError("Sample fraction must be in (0, 1]", 2)
+    if sample_repeats < 1:
+        raise ScriptError("Subsampling needs at least one repeat", 2)
+    if min_pairs < 1:
+        raise ScriptError("Subsampling screens on min-pairs, so it needs a " 
+                          "min-pairs cutoff of at least 1", 2)
+    validate_options(test=test, qvalue_method=qvalue_method)
+    log_cutoffs(min_pairs, ef_cutoff, qvalue_cutoff)
+    logging.info("Using random seed %d" % random_seed)
+    timer = StageTimer(workers=jobs > 1)
+    incidence, targets = read_incidence(events_reader, results_reader, 
+                                        vocabulary=vocabulary, 
+                                        cache_fn=cache_fn)
+    incidence = collapse_incidence(incidence)
+    timer("input")
+    samples = sample_pair_counts(incidence, sample_fraction, sample_repeats, 
+                                 random_seed, jobs=jobs)
+    num_targets = len(incidence.targets)
+    samples = [(pair_keys(pair_counts), E, T, P) for 
+               pair_counts, E, T, P in samples]
+    candidates = np.unique(np.concatenate([keys for (keys, counts), E, T, P 
+                                           in samples]))
+    rows, cols = candidates // num_targets, candidates % num_targets
+    # EF is a ratio of counts, so subsample EFs need no rescaling
+    sample_counts = np.zeros(len(rows))
+    sample_efs = np.zeros((sample_repeats, len(rows)))
+    for i, ((keys, counts), E, T, P) in enumerate(samples):
+        pte = lookup_keys(keys, counts, candidates).astype(np.float64)
+        sample_counts += pte
+        with np.errstate(divide="ignore", invalid="ignore"):
+            efs = pte / (E[rows] * T[cols]) * P
+        sample_efs[i] = np.where(np.isfinite(efs), efs, 0.0)
+    del samples
+    tail = (100.0 - SAMPLE_CONFIDENCE) / 2
+    sample_mean = sample_efs.mean(axis=0)
+    sample_low, sample_high = np.percentile(sample_efs, [tail, 100 - tail], 
+                                            axis=0)
+    del sample_efs
+    # Each molecule enters a subsample with probability sample_fraction, 
+    # so scaled counts estimate the full count with a binomial spread. 
+    # Pairs whose upper bound reaches min-pairs get exact counts, and a 
+    # fraction of 1 keeps exactly the pairs that pass min-pairs.
+    draws = sample_fraction * sample_repeats
+    estimate = sample_counts / draws
+    spread = np.sqrt(estimate * (1 - sample_fraction) / draws)
+    upper = estimate + stats.norm.ppf(1 - tail / 100) * spread
+    screened = upper >= min_pairs
+    logging.info("Subsamples screened %d of %d candidate pairs for exact " 
+                 "counts" % (screened.sum(), len(candidates)))
+    timer("subsampled enrichment factors")
+    rows, cols = rows[screened], cols[screened]
+    E, T, P, target_counts = incidence_margins(incidence)
+    pte = pair_sums(incidence, rows, cols, incidence_weights(incidence))
+    # Pairs passing min-pairs are tested, just as in a full run
+    tested = pte >= min_pairs
+    # A full sample screens exactly the pairs that a full run tests
+    assert(sample_fraction < 1 or tested.all())
+    rows, cols, pte = rows[tested], cols[tested], pte[tested]
+    # Same operation order as the full engines, so exact EFs agree
+    efs = pte.astype(np.float64) / (E[rows] * T[cols])
+    efs = EFTable(rows, cols, pte, efs * P)
+    logging.info("Computed %d target-event enrichment factors" % 
+                 len(efs.efs))
+    timer("exact enrichment factors")
+    efs, contingencies, bonferroni_count = tested_contingencies(efs, 
+        lambda efs: pair_contingencies(efs, incidence), 
+        bonferroni=bonferroni, ef_cutoff=ef_cutoff)
+    timer("contingency tables")
+    # Subsample intervals are looked up by pair key for the tested pairs
+    keys = efs.events.astype(np.int64) * num_targets + efs.targets
+    extra_columns = [(name, lookup_keys(candidates, values, keys)) for 
+                     name, values in (("sample_ef", sample_mean), 
+                                      ("sample_ef_low", sample_low), 
+                                      ("sample_ef_high", sample_high))]
+    for row in ef_results(efs, contingencies, incidence.events, 
+                          incidence.targets, targets, ef_cutoff=ef_cutoff, 
+                          qvalue_cutoff=qvalue_cutoff, 
+                          bonferroni_count=bonferroni_count, test=test, 
+                          qvalue_method=qvalue_method, 
+                          max_sort_pairs=max_sort_pairs, timer=timer, 
+                          extra_columns=extra_columns):
+        yield row
+
+
+def bootstrap_efs(incidence, rows, cols, replicates, 
+                  random_seed=SAMPLE_SEED):
+    """EFs of event-target pairs over bootstrap resamples of molecules"""
+    drug_events = incidence.drug_events.tocsr()
+    drug_targets = incidence.drug_targets.tocsr()
+    event_counts = np.diff(drug_events.indptr)
+    target_counts = np.diff(drug_targets.indptr)
+    # Molecules without events or targets never enter an EF
+    linked = np.nonzero((event_counts > 0) & (target_counts > 0))[0]
+    drug_events = drug_events[linked].tocsc()
+    drug_targets = drug_targets[linked].tocsc()
+    event_counts = event_counts[linked].astype(np.float64)
+    target_counts = target_counts[linked].astype(np.float64)
+    weights = incidence_weights(incidence)[linked]
+    num_molecules = int(weights.sum())
+    # Each resample is a vector of molecule counts, so pte, E, T, and P 
+    # for all resamples in a batch are sparse products with the count matrix
+    shared = drug_events[:, rows].multiply(drug_targets[:, cols]).T.tocsr()
+    events, event_index = np.unique(rows, return_inverse=True)
+    targets, target_index = np.unique(cols, return_inverse=True)
+    event_sums = drug_events[:, events].T.dot(
+        sparse.diags(target_counts, 0)).tocsr()
+    target_sums = drug_targets[:, targets].T.dot(
+        sparse.diags(event_counts, 0)).tocsr()
+    pair_totals = event_counts * target_counts
+    random_state = np.random.RandomState(random_seed)
+    efs = np.zeros((len(rows), replicates))
+    logging.info("Computing EFs for %d pairs over %d bootstrap resamples " 
+                 "of %d molecules" % (len(rows), replicates, num_molecules))
+    for start in xrange(0, replicates, BOOTSTRAP_BATCH):
+        batch = min(BOOTSTRAP_BATCH, replicates - start)
+        counts = random_state.multinomial(num_molecules, 
+            weights / float(num_molecules), size=batch).T.astype(np.float64)
+        pte = shared.dot(counts)
+        E = event_sums.dot(counts)[event_index]
+        T = target_sums.dot(counts)[target_index]
+        P = pair_totals.dot(counts)
+        # Resamples missing an event or target leave its EF undefined
+        with np.errstate(divide="ignore", invalid="ignore"):
+            batch_efs = pte / (E * T) * P
+        efs[:, start:start+batch] = np.where(np.isfinite(batch_efs), 
+                                             batch_efs, 0.0)
+    return efs
+
+
+def bootstrap_columns(incidence, efs, passed, replicates, 
+                      random_seed=SAMPLE_SEED, timer=None):
+    """Percentile bootstrap EF interval columns for the written pairs"""
+    tail = (100.0 - SAMPLE_CONFIDENCE) / 2
+    low = np.zeros(len(efs.efs))
+    high = np.zeros(len(efs.efs))
+    if len(passed):
+        resampled = bootstrap_efs(incidence, efs.events[passed], 
+                                  efs.targets[passed], replicates, 
+                                  random_seed=random_seed)
+        low[passed], high[passed] = np.percentile(resampled, 
+            [tail, 100 - tail], axis=1)
+    if timer is not None:
+        timer("bootstrap intervals")
+    return [("ef_low", low), ("ef_high", high)]
+
+
+def random_clusters(random_state, sizes, num_molecules):
+    """Draw clusters of distinct molecule indices with the given sizes"""
+    clusters = np.repeat(np.arange(len(sizes)), sizes)
+    members = random_state.randint(num_molecules, size=len(clusters))
+    while True:
+        keys = np.unique(clusters.astype(np.int64) * num_molecules + members)
+        if len(keys) == len(clusters):
+            return clusters, members
+        # Redraw molecules repeated within a cluster until all are distinct
+        clusters, members = keys // num_molecules, keys % num_molecules
+        missing = sizes - np.bincount(clusters, minlength=len(sizes))
+        clusters = np.concatenate([clusters, 
+            np.repeat(np.arange(len(sizes)), missing)])
+        members = np.concatenate([members, 
+            random_state.randint(num_molecules, size=missing.sum())])
+
+
+def linked_event_sizes(incidence):
+    """Number of molecules with targets behind each event"""
+    degrees = np.diff(incidence.drug_targets.tocsr().indptr)
+    return incidence.drug_events.T.dot(
+        np.where(degrees > 0, incidence_weights(incidence), 0))
+
+
+def size_bins(sizes):
+    """Log scale bin of each event size"""
+    return np.floor(np.log2(np.maximum(sizes, 1)) / 
+                    NULL_BIN_WIDTH).astype(np.int64)
+
+
+def null_efs(incidence, num_clusters, sizes, min_pairs=CUTOFF_MINPAIRS, 
+             random_state=None):
+    """Targets and EFs of random clusters, sized like sizes, per target"""
+    if random_state is None:
+        random_state = np.random.RandomState(SAMPLE_SEED)
+    E, T, P, target_counts = incidence_margins(incidence)
+    weights = incidence_weights(incidence)
+    drug_targets = incidence.drug_targets.tocsr()
+    degrees = np.diff(drug_targets.indptr)
+    # Clusters draw from molecules with targets
+    rows = np.nonzero(degrees)[0]
+    bounds = np.cumsum(weights[rows])
+    num_molecules = int(bounds[-1]) if len(bounds) else 0
+    null_targets = [np.zeros(0, dtype=np.int64)]
+    null_values = [np.zeros(0)]
+    for start in xrange(0, num_clusters, NULL_BATCH):
+        batch = min(NULL_BATCH, num_clusters - start)
+        cluster_sizes = sizes[random_state.randint(len(sizes), size=batch)]
+        clusters, members = random_clusters(random_state, cluster_sizes, 
+                                            num_molecules)
+        # Weighted rows hold several molecules, each counted when drawn
+        members = rows[np.searchsorted(bounds, members, side="right")]
+        drug_clusters = sparse.coo_matrix(
+            (np.ones(len(members), dtype=np.int64), (clusters, members)), 
+            shape=(batch, len(weights))).tocsr()
+        pair_counts = drug_clusters.dot(drug_targets).tocoo()
+        cluster_E = drug_clusters.dot(degrees)
+        keep = pair_counts.data >= max(min_pairs, 1)
+        cluster_rows = pair_counts.row[keep]
+        cols = pair_counts.col[keep]
+        # Clusters are scored as extra events against the real background
+        efs = pair_counts.data[keep].astype(np.float64) / \
+              (cluster_E[cluster_rows] * T[cols])
+        null_targets.append(cols)
+        null_values.append(efs * P)
+    return np.concatenate(null_targets), np.concatenate(null_values)
+
+
+def count_exceeding(null_targets, null_values, targets, values):
+    """Count null EFs of the same target at or above each value"""
+    order = np.lexsort((null_values, null_targets))
+    null_targets, null_values = null_targets[order], null_values[order]
+    starts = np.searchsorted(null_targets, targets)
+    ends = np.searchsorted(null_targets, targets, side="right")
+    exceed = np.zeros(len(targets), dtype=np.int64)
+    for i in xrange(len(targets)):
+        exceed[i] = ends[i] - starts[i] - np.searchsorted(
+            null_values[starts[i]:ends[i]], values[i])
+    return exceed
+
+
+def null_columns(incidence, efs, passed, num_clusters, 
+                 min_pairs=CUTOFF_MINPAIRS, random_seed=SAMPLE_SEED, 
+                 timer=None):
+    """Empirical p-value columns of written pairs against random clusters"""
+    null_p = np.ones(len(efs.efs))
+    if len(passed):
+        # Pair counts and EFs depend on event size, so each pair is only 
+        # compared with clusters sized like the events in its size bin
+        event_sizes = linked_event_sizes(incidence)
+        bins = size_bins(event_sizes)
+        pair_bins = bins[efs.events[passed]]
+        random_state = np.random.RandomState(random_seed)
+        size_bin_list = np.unique(pair_bins)
+        logging.info("Computing EFs for %d random clusters in each of %d " 
+                     "event size bins" % (num_clusters, len(size_bin_list)))
+        for size_bin in size_bin_list:
+            in_bin = passed[pair_bins == size_bin]
+            sizes = event_sizes[(bins == size_bin) & (event_sizes > 0)]
+            null_targets, null_values = null_efs(incidence, num_clusters, 
+                sizes, min_pairs=min_pairs, random_state=random_state)
+            exceed = count_exceeding(null_targets, null_values, 
+                                     efs.targets[in_bin], efs.efs[in_bin])
+            # Count the real pair itself, so p-values never reach zero
+            null_p[in_bin] = (exceed + 1.0) / (num_clusters + 1)
+    if timer is not None:
+        timer("empirical null")
+    return [("null_p", null_p)]
+
+
+def affinity_key(affinity):
+    """Sort affinity groups from tightest to loosest, blanks last"""
+    try:
+        return (0, float(affinity), affinity)
+    except ValueError:
+        return (1, 0.0, affinity)
+
+
+def tier_matrices(target_edges, tier_names, shape):
+    """Yield cumulative drug x target incidence per affinity tier"""
+    drug_codes, target_codes, tier_codes = target_edges
+    cumulative = sparse.csc_matrix(shape, dtype=np.int32)
+    for code, name in sorted(enumerate(tier_names), 
+                             key=lambda x: affinity_key(x[1])):
+        in_tier = tier_codes == code
+        cumulative = cumulative + edges_to_matrix(drug_codes[in_tier], 
+            target_codes[in_tier], shape)
+        # Sums count molecules linked in several tiers more than once
+        drug_targets = cumulative.copy()
+        drug_targets.data[:] = 1
+        yield name, drug_targets
+
+
+def ef_tiers(events_reader, results_reader, min_pairs=CUTOFF_MINPAIRS, 
+             ef_cutoff=CUTOFF_EF, qvalue_cutoff=CUTOFF_QVALUE, 
+             bonferroni=False, engine="sparse", test="chi2", 
+             qvalue_method="holm", max_sort_pairs=None, jobs=1, 
+             vocabulary=None):
+    """Compute EFs and q-values for every cumulative affinity tier."""
+    if engine != "sparse":
+        raise ScriptError("Affinity tiers require the sparse EF engine", 2)
+    validate_options(test=test, qvalue_method=qvalue_method)
+    log_cutoffs(min_pairs, ef_cutoff, qvalue_cutoff)
+    timer = StageTimer(workers=jobs > 1)
+    if vocabulary is None:
+        vocabulary = new_vocabulary()
+    tiers = Interner()
+    event_edges, has_event = read_event_codes(events_reader, vocabulary)
+    target_edges, has_target, targets = read_result_codes(results_reader, 
+        vocabulary, has_event, tiers=tiers)
+    # The loosest tier links every molecule, so it sets the pruning
+    incidence = build_incidence(vocabulary, event_edges, target_edges[:2], 
+                                has_event, has_target)
+    shape = incidence.drug_targets.shape
+    logging.info("Computing EFs for %d affinity tiers" % len(tiers.names))
+    # Event side products are shared by every tier
+    event_drugs = incidence.drug_events.T.tocsr()
+    timer("input")
+    header = True
+    for tier, drug_targets in tier_matrices(target_edges, tiers.names, 
+                                            shape):
+        logging.info("Affinity tier %s holds %d drug-target pairs" % 
+                     (tier, drug_targets.nnz))
+        tier_incidence = incidence._replace(drug_targets=drug_targets)
+        if jobs > 1:
+            pair_counts, E, T, P = compute_pair_counts_parallel(
+                tier_incidence, jobs)
+        else:
+            pair_counts = event_drugs.dot(drug_targets).tocsr()
+            E = np.asarray(pair_counts.sum(axis=1), dtype=np.int64).ravel()
+            T = np.asarray(pair_counts.sum(axis=0), dtype=np.int64).ravel()
+            P = int(E.sum())
+        efs = efs_from_pair_counts(pair_counts, E, T, P, min_pairs=min_pairs)
+        del pair_counts
+        timer("enrichment factors")
+        efs, contingencies, bonferroni_count = tested_contingencies(efs, 
+            lambda efs: map_contingency_tables_sparse(efs, tier_incidence), 
+            bonferroni=bonferroni, ef_cutoff=ef_cutoff)
+        timer("contingency tables")
+        extra_columns = [("affinity_tier", [tier] * len(efs.efs))]
+        rows = ef_results(efs, contingencies, incidence.events, 
+                          incidence.targets, targets, ef_cutoff=ef_cutoff, 
+                          qvalue_cutoff=qvalue_cutoff, 
+                          bonferroni_count=bonferroni_count, test=test, 
+                          qvalue_method=qvalue_method, 
+                          max_sort_pairs=max_sort_pairs, timer=timer, 
+                          extra_columns=extra_columns)
+        # Every tier shares one output, so only the first header is written
+        if not header:
+            rows.next()
+        header = False
+        for row in rows:
+            yield row
+
+
+def read_event_parents(parents_reader):
+    """Read event to parent event mapping, allowing several parents"""
+    logging.info("Reading event hierarchy")
+    parents = defaultdict(list)
+    for row in parents_reader:
+        eid, parent = row[:2]
+        parents[eid].append(parent)
+    logging.info("Mapped %d events to parent events" % len(parents))
+    return parents
+
+
+def event_levels(incidence, parents):
+    """Yield (level, incidence) rolling events up the hierarchy"""
+    level = 0
+    while True:
+        yield level, incidence
+        parent_ids = Interner()
+        rows = array("i")
+        cols = array("i")
+        for i, eid in enumerate(incidence.events):
+            for parent in parents.get(eid, ()):
+                rows.append(i)
+                cols.append(parent_ids.intern(parent))
+        if not len(rows):
+            break
+        level += 1
+        if level > len(parents):
+            raise ScriptError("Event hierarchy contains a cycle", 2)
+        # Drugs link a parent event when they link any of its children
+        aggregation = edges_to_matrix(np.frombuffer(rows, dtype=np.int32), 
+                                      np.frombuffer(cols, dtype=np.int32), 
+                                      (len(incidence.events), 
+                                       len(parent_ids.names)))
+        drug_events = incidence.drug_events.dot(aggregation).tocsc()
+        drug_events.data[:] = 1
+        logging.info("Rolled %d events up to %d level %d events" % 
+                     (len(incidence.events), len(parent_ids.names), level))
+        incidence = incidence._replace(events=parent_ids.names, 
+                                       drug_events=drug_events)
+
+
+def ef_hierarchy(events_reader, results_reader, parents_reader, 
+                 min_pairs=CUTOFF_MINPAIRS, ef_cutoff=CUTOFF_EF, 
+                 qvalue_cutoff=CUTOFF_QVALUE, bonferroni=False, 
+                 engine="sparse", test="chi2", qvalue_method="holm", 
+                 max_sort_pairs=None, jobs=1, vocabulary=None, cache_fn=None):
+    """Compute EFs and q-values for every level of an event hierarchy."""
+    if engine != "sparse":
+        raise ScriptError("Event hierarchies require the sparse EF engine", 2)
+    validate_options(test=test, qvalue_method=qvalue_method)
+    log_cutoffs(min_pairs, ef_cutoff, qvalue_cutoff)
+    timer = StageTimer(workers=jobs > 1)
+    parents = read_event_parents(parents_reader)
+    incidence, targets = read_incidence(events_reader, results_reader, 
+                                        vocabulary=vocabulary, 
+                                        cache_fn=cache_fn)
+    # Identical leaf events imply identical parents, so rows collapse once
+    incidence = collapse_incidence(incidence)
+    timer("input")
+    header = True
+    for level, level_incidence in event_levels(incidence, parents):
+        efs = compute_efs_sparse(level_incidence, min_pairs=min_pairs, 
+                                 jobs=jobs)
+        timer("enrichment factors")
+        efs, contingencies, bonferroni_count = tested_contingencies(efs, 
+            lambda efs: map_contingency_tables_sparse(efs, level_incidence), 
+            bonferroni=bonferroni, ef_cutoff=ef_cutoff)
+        timer("contingency tables")
+        extra_columns = [("level", [str(level)] * len(efs.efs))]
+        rows = ef_results(efs, contingencies, level_incidence.events, 
+                          level_incidence.targets, targets, 
+                          ef_cutoff=ef_cutoff, qvalue_cutoff=qvalue_cutoff, 
+                          bonferroni_count=bonferroni_count, test=test, 
+                          qvalue_method=qvalue_method, 
+                          max_sort_pairs=max_sort_pairs, timer=timer, 
+                          extra_columns=extra_columns)
+        # Every level shares one output, so only the first header is written
+        if not header:
+            rows.next()
+        header = False
+        for row in rows:
+            yield row
+
+
+def arrays_to_coo(shard, prefix, row_map, col_map):
+    """Rebuild a shard sparse matrix as COO arrays in global indices"""
+    matrix = arrays_to_sparse(shard, prefix).tocoo()
+    return row_map[matrix.row], col_map[matrix.col], matrix.data
+
+
+def ef_map(events_reader, results_reader, shard=None, jobs=1, 
+           vocabulary=None, cache_fn=None):
+    """Compute partial EF sums for one slice of the events"""
+    if shard is not None:
+        logging.info("Selecting events in shard %d of %d" % 
+                     (shard[0] + 1, shard[1]))
+    incidence, targets = read_incidence(events_reader, results_reader, 
+                                        vocabulary=vocabulary, shard=shard, 
+                                        cache_fn=cache_fn)
+    if jobs > 1:
+        pair_counts, E, T, P = compute_pair_counts_parallel(incidence, jobs)
+    else:
+        pair_counts, E, T, P = compute_pair_counts(incidence)
+    sums = contingency_sums(incidence)
+    # Pair counts, both, E, T, P and event sums add across event shards,
+    # while target sums need each drug's targets counted only once
+    arrays = {"events": np.array(incidence.events), 
+              "targets": np.array(incidence.targets), 
+              "drugs": np.array(incidence.drugs), 
+              "named_targets": np.array(sorted(targets)), 
+              "target_names": np.array([targets[t].name for t in 
+                                        sorted(targets)]), 
+              "target_descs": np.array([targets[t].description for t in 
+                                        sorted(targets)]), 
+              "E": E, "T": T, "P": np.array(P), 
+              "event_sums": sums.event_sums}
+    arrays.update(sparse_to_arrays("pair_counts", pair_counts))
+    arrays.update(sparse_to_arrays("both", sums.both))
+    arrays.update(sparse_to_arrays("drug_targets", incidence.drug_targets))
+    logging.info("Computed partial P = %d over %d events" % 
+                 (P, len(incidence.events)))
+    return arrays
+
+
+def global_index(names, shard_names):
+    """Map shard name indices to global sorted name indices"""
+    index = dict((name, i) for i, name in enumerate(names))
+    return np.array([index[name] for name in shard_names], dtype=np.int64)
+
+
+def ef_reduce(shard_fns, min_pairs=CUTOFF_MINPAIRS, ef_cutoff=CUTOFF_EF, 
+              qvalue_cutoff=CUTOFF_QVALUE, bonferroni=False, test="chi2", 
+              qvalue_method="holm", max_sort_pairs=None):
+    """Merge partial EF shards and write enrichment factors and q-values"""
+    validate_options(test=test, qvalue_method=qvalue_method)
+    log_cutoffs(min_pairs, ef_cutoff, qvalue_cutoff)
+    shards = []
+    for shard_fn in shard_fns:
+        logging.info("Reading EF shard: %s" % shard_fn)
+        shards.append(dict(np.load(shard_fn).items()))
+    events = sorted(set().union(*[s["events"].tolist() for s in shards]))
+    drugs = sorted(set().union(*[s["drugs"].tolist() for s in shards]))
+    target_ids = sorted(set().union(*[s["targets"].tolist() for s in shards]))
+    targets = {}
+    for shard in shards:
+        for tid, name, desc in zip(shard["named_targets"].tolist(), 
+                                   shard["target_names"].tolist(), 
+                                   shard["target_descs"].tolist()):
+            if tid not in targets:
+                targets[tid] = Target(name, desc)
+    logging.info("Merging %d shards over %d events, %d targets, and %d " 
+                 "molecules" % (len(shards), len(events), len(target_ids), 
+                 len(drugs)))
+    shape = (len(events), len(target_ids))
+    E = np.zeros(len(events), dtype=np.int64)
+    T = np.zeros(len(target_ids), dtype=np.int64)
+    P = 0
+    event_sums = np.zeros(len(events), dtype=np.int64)
+    parts = {"pair_counts": [], "both": [], "drug_targets": []}
+    for shard in shards:
+        event_map = global_index(events, shard["events"].tolist())
+        target_map = global_index(target_ids, shard["targets"].tolist())
+        drug_map = global_index(drugs, shard["drugs"].tolist())
+        np.add.at(E, event_map, shard["E"])
+        np.add.at(T, target_map, shard["T"])
+        np.add.at(event_sums, event_map, shard["event_sums"])
+        P += int(shard["P"])
+        for prefix in ("pair_counts", "both"):
+            parts[prefix].append(arrays_to_coo(shard, prefix, event_map, 
+                                               target_map))
+        parts["drug_targets"].append(arrays_to_coo(shard, "drug_targets", 
+                                                   drug_map, target_map))
+    merged = {}
+    for prefix, matrix_shape in (("pair_counts", shape), ("both", shape), 
+            ("drug_targets", (len(drugs), len(target_ids)))):
+        rows, cols, data = [np.concatenate(x) for x in zip(*parts[prefix])]
+        merged[prefix] = sparse.coo_matrix((data, (rows, cols)), 
+                                           shape=matrix_shape).tocsr()
+    del parts
+    logging.info("Reduced global P = %d" % P)
+    # Drugs repeat across shards, so count each drug-target pair once
+    drug_targets = merged["drug_targets"]
+    drug_targets.data[:] = 1
+    target_counts = np.asarray(drug_targets.sum(axis=1), 
+                               dtype=np.int64).ravel()
+    target_sums = drug_targets.T.dot(target_counts)
+    sums = ContingencySums(merged["both"], event_sums, target_sums, 
+                           int(target_counts.sum()))
+    for row in summed_ef_results(merged["pair_counts"], E, T, P, sums, 
+                                 events, target_ids, targets, 
+                                 min_pairs=min_pairs, ef_cutoff=ef_cutoff, 
+                                 qvalue_cutoff=qvalue_cutoff, 
+                                 bonferroni=bonferroni, test=test, 
+                                 qvalue_method=qvalue_method, 
+                                 max_sort_pairs=max_sort_pairs):
+        yield row
+
+
+def summed_ef_results(pair_counts, E, T, P, sums, event_names, target_names, 
+                      targets, min_pairs=CUTOFF_MINPAIRS, ef_cutoff=CUTOFF_EF, 
+                      qvalue_cutoff=CUTOFF_QVALUE, bonferroni=False, 
+                      test="chi2", qvalue_method="holm", max_sort_pairs=None):
+    """Yield output rows from summed pair counts and contingency sums"""
+    efs = efs_from_pair_counts(pair_counts, E, T, P, min_pairs=min_pairs)
+    logging.info("Computing contingency tables")
+    efs, contingencies, bonferroni_count = tested_contingencies(efs, 
+        lambda efs: contingencies_from_sums(efs, sums), 
+        bonferroni=bonferroni, ef_cutoff=ef_cutoff)
+    for row in ef_results(efs, contingencies, event_names, target_names, 
+                          targets, ef_cutoff=ef_cutoff, 
+                          qvalue_cutoff=qvalue_cutoff, 
+                          bonferroni_count=bonferroni_count, test=test, 
+                          qvalue_method=qvalue_method, 
+                          max_sort_pairs=max_sort_pairs):
+        yield row
+
+
+def new_ef_state(results_reader, results_hash):
+    """Start an incremental EF state from the full SEAware results"""
+    vocabulary = new_vocabulary()
+    target_edges, has_target, targets = read_result_codes(results_reader, 
+                                                          vocabulary)
+    num_drugs = len(vocabulary["molecule"])
+    num_targets = len(vocabulary["target"])
+    drug_targets = edges_to_matrix(target_edges[0], target_edges[1], 
+                                   (num_drugs, num_targets))
+    return EFState(results_hash, vocabulary, targets, 
+                   sparse.csc_matrix((num_drugs, 0), dtype=np.int32), 
+                   drug_targets, 
+                   sparse.csr_matrix((0, num_targets), dtype=np.int32), 
+                   sparse.csr_matrix((0, num_targets), dtype=np.int64), 
+                   np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+
+def read_ef_state(state_fn):
+    """Load an incremental EF state saved as npz"""
+    logging.info("Reading EF state: %s" % state_fn)
+    arrays = np.load(state_fn)
+    try:
+        vocabulary = dict((kind, Interner(arrays[kind + "_ids"].tolist())) 
+                          for kind in VOCABULARY_KINDS)
+        targets = dict((tid, Target(name, desc)) for tid, name, desc in 
+                       zip(arrays["named_targets"].tolist(), 
+                           arrays["target_names"].tolist(), 
+                           arrays["target_descs"].tolist()))
+        state = EFState(str(arrays["results_hash"]), vocabulary, targets, 
+                        arrays_to_sparse(arrays, "drug_events"), 
+                        arrays_to_sparse(arrays, "drug_targets"), 
+                        arrays_to_sparse(arrays, "pair_counts"), 
+                        arrays_to_sparse(arrays, "both"), 
+                        arrays["E"], arrays["event_sums"])
+    finally:
+        arrays.close()
+    logging.info("EF state holds %d events, %d targets, and %d molecules" % 
+                 tuple(len(vocabulary[kind]) for kind in 
+                       ("event", "target", "molecule")))
+    return state
+
+
+def write_ef_state(state_fn, state):
+    """Save per-event pair counts and sums with the target incidence"""
+    logging.info("Writing EF state: %s" % state_fn)
+    named_targets = sorted(state.targets)
+    arrays = {"results_hash": np.array(state.results_hash), 
+              "named_targets": np.array(named_targets), 
+              "target_names": np.array([state.targets[t].name for t in 
+                                        named_targets]), 
+              "target_descs": np.array([state.targets[t].description for t in 
+                                        named_targets]), 
+              "E": state.E, "event_sums": state.event_sums}
+    for kind in VOCABULARY_KINDS:
+        arrays[kind + "_ids"] = np.array(state.vocabulary[kind].names)
+    for prefix in ("drug_events", "drug_targets", "pair_counts", "both"):
+        arrays.update(sparse_to_arrays(prefix, getattr(state, prefix)))
+    # Write to a temporary name, so an interrupted update keeps the old state
+    tmp_fn = state_fn + ".%d.tmp" % os.getpid()
+    state_f = open(tmp_fn, "wb")
+    try:
+        np.savez_compressed(state_f, **arrays)
+    finally:
+        state_f.close()
+    os.rename(tmp_fn, state_fn)
+
+
+def pad_matrix(matrix, shape):
+    """Grow a sparse matrix to a larger shape with empty rows and columns"""
+    coo = matrix.tocoo()
+    return sparse.coo_matrix((coo.data, (coo.row, coo.col)), shape=shape, 
+                             dtype=matrix.dtype).asformat(matrix.format)
+
+
+def replace_rows(matrix, rows, new_rows):
+    """Replace the given rows of a sparse matrix with new sparse rows"""
+    keep = np.ones(matrix.shape[0], dtype=matrix.dtype)
+    keep[rows] = 0
+    kept = sparse.diags(keep, 0).dot(matrix).tocoo()
+    placed = new_rows.tocoo()
+    replaced = sparse.coo_matrix(
+        (np.concatenate((kept.data, placed.data)), 
+         (np.concatenate((kept.row, rows[placed.row])), 
+          np.concatenate((kept.col, placed.col)))), 
+        shape=matrix.shape, dtype=matrix.dtype).tocsr()
+    replaced.eliminate_zeros()
+    return replaced
+
+
+def update_ef_state(state, events_reader, append=False, jobs=1):
+    """Recompute pair counts and sums for new or changed events only"""
+    vocabulary = state.vocabulary
+    event_edges, has_event = read_event_codes(events_reader, vocabulary)
+    num_drugs = len(vocabulary["molecule"])
+    num_events = len(vocabulary["event"])
+    num_targets = len(vocabulary["target"])
+    drug_targets = pad_matrix(state.drug_targets, (num_drugs, num_targets))
+    old_events = pad_matrix(state.drug_events, (num_drugs, num_events))
+    # Prune event molecules that are not mapped to targets
+    has_target = np.diff(drug_targets.tocsr().indptr) > 0
+    keep = has_target[event_edges[0]]
+    logging.info("Pruned %d event molecules that were not mapped to targets" % 
+                 (has_event & ~has_target).sum())
+    drug_events = edges_to_matrix(event_edges[0][keep], event_edges[1][keep], 
+                                  (num_drugs, num_events))
+    if append:
+        drug_events = drug_events + old_events
+        drug_events.data[:] = 1
+    delta = (drug_events - old_events).tocsc()
+    delta.eliminate_zeros()
+    changed = np.nonzero(np.diff(delta.indptr))[0]
+    logging.info("Recomputing %d new or changed events of %d" % 
+                 (len(changed), num_events))
+    pair_counts = pad_matrix(state.pair_counts, (num_events, num_targets))
+    both = pad_matrix(state.both, (num_events, num_targets))
+    E = np.zeros(num_events, dtype=np.int64)
+    E[:len(state.E)] = state.E
+    event_sums = np.zeros(num_events, dtype=np.int64)
+    event_sums[:len(state.event_sums)] = state.event_sums
+    if len(changed):
+        event_names = vocabulary["event"].names
+        incidence = Incidence(vocabulary["molecule"].names, 
+                              [event_names[i] for i in changed], 
+                              vocabulary["target"].names, 
+                              drug_events[:, changed], drug_targets)
+        if jobs > 1:
+            changed_counts, changed_E, changed_T, changed_P = \
+                compute_pair_counts_parallel(incidence, jobs)
+        else:
+            changed_counts, changed_E, changed_T, changed_P = \
+                compute_pair_counts(incidence)
+        changed_sums = contingency_sums(incidence)
+        pair_counts = replace_rows(pair_counts, changed, changed_counts)
+        both = replace_rows(both, changed, changed_sums.both)
+        E[changed] = changed_E
+        event_sums[changed] = changed_sums.event_sums
+    return EFState(state.results_hash, vocabulary, state.targets, 
+                   drug_events, drug_targets, pair_counts, both, E, 
+                   event_sums)
+
+
+def ef_update(events_reader, results_reader, state_fn, results_hash, 
+              append=False, jobs=1, **kwargs):
+    """Update the EF state with new events and yield the output rows"""
+    state = None
+    if op.exists(state_fn):
+        state = read_ef_state(state_fn)
+        if state.results_hash != results_hash:
+            logging.info("SEAware results changed, so rebuilding EF state")
+            state = None
+    if state is None:
+        if append:
+            raise ScriptError("Appending events requires an existing EF " 
+                              "state for the same SEAware results", 2)
+        state = new_ef_state(results_reader, results_hash)
+    state = update_ef_state(state, events_reader, append=append, jobs=jobs)
+    write_ef_state(state_fn, state)
+    # Global sums are re-derived from the stored per-event contributions
+    T = np.asarray(state.pair_counts.sum(axis=0), dtype=np.int64).ravel()
+    P = int(state.E.sum())
+    logging.info("Updated global P = %d" % P)
+    target_counts = np.asarray(state.drug_targets.sum(axis=1), 
+                               dtype=np.int64).ravel()
+    # Only molecules linked to events count towards the contingency tables
+    target_counts[np.diff(state.drug_events.tocsr().indptr) == 0] = 0
+    sums = ContingencySums(state.both, state.event_sums, 
+                           state.drug_targets.T.dot(target_counts), 
+                           int(target_counts.sum()))
+    for row in summed_ef_results(state.pair_counts, state.E, T, P, sums, 
+                                 state.vocabulary["event"].names, 
+                                 state.vocabulary["target"].names, 
+                                 state.targets, **kwargs):
+        yield row
+
+
+def vocabulary_sizes(vocabulary):
+    """Count the IDs held by each interner"""
+    return [len(vocabulary[kind]) for kind in VOCABULARY_KINDS]
+
+
+def map_handler(events_fn, results_fn, out_fn, vocabulary_fn=None, 
+                cache_dir=None, **kwargs):
+    """I/O handling for the map subcommand."""
+    cache_fn = None
+    if cache_dir:
+        cache_fn = incidence_cache_fn(cache_dir, events_fn, results_fn, 
+                                      kwargs.get("shard"))
+    vocabulary = read_vocabulary(vocabulary_fn)
+    sizes = vocabulary_sizes(vocabulary)
+    logging.info("Events file: %s" % events_fn)
+    events_f = open(events_fn, "r")
+    events_reader = csv.reader(events_f)
+    logging.info("SEAware results file: %s" % results_fn)
+    results_f = open(results_fn, "r")
+    results_reader = csv.reader(results_f)
+    logging.info("Output shard file: %s" % out_fn)
+    try:
+        try:
+            arrays = ef_map(events_reader, results_reader, 
+                            vocabulary=vocabulary, cache_fn=cache_fn, 
+                            **kwargs)
+            out_f = open(out_fn, "wb")
+            try:
+                np.savez_compressed(out_f, **arrays)
+            finally:
+                out_f.close()
+            if vocabulary_fn and vocabulary_sizes(vocabulary) != sizes:
+                write_vocabulary(vocabulary_fn, vocabulary)
+        except ScriptError, message:
+            logging.error(message)
+            return message.value
+    finally:
+        events_f.close()
+        results_f.close()
+    return 0
+
+
+def reduce_handler(shard_fns, out_fn, **kwargs):
+    """I/O handling for the reduce subcommand."""
+    out_f = open(out_fn, "w")
+    logging.info("Output file: %s" % out_fn)
+    out_writer = csv.writer(out_f)
+    try:
+        try:
+            for result in ef_reduce(shard_fns, **kwargs):
+                out_writer.writerow(result)
+        except ScriptError, message:
+            logging.error(message)
+            return message.value
+    finally:
+        out_f.close()
+    return 0
+
+
+def handler(events_fn, results_fn, out_fn, vocabulary_fn=None, 
+            cache_dir=None, memory_limit=None, sample_fraction=None, 
+            affinity_tiers=False, parents_fn=None, **kwargs):
     """I/O handling for the script."""
+    cache_fn = None
+    if cache_dir and kwargs.get("engine", "sparse") == "sparse" and \
+            not memory_limit and not affinity_tiers:
+        cache_fn = incidence_cache_fn(cache_dir, events_fn, results_fn)
+    vocabulary = read_vocabulary(vocabulary_fn)
+    sizes = vocabulary_sizes(vocabulary)
+    logging.info("Events file: %s" % events_fn)
+    events_f = open(events_fn, "r")
+    # Rereadable events let the set engine prune them on read
+    events_reader = RereadableReader(events_f)
+    logging.info("SEAware results file: %s" % results_fn)
+    results_f = open(results_fn, "r")
+    results_reader = csv.reader(results_f)
+    out_f = open(out_fn, "w")
+    logging.info("Output file: %s" % out_fn)
+    out_writer = csv.writer(out_f)
+    if memory_limit:
+        results = ef_out_of_core(events_reader, results_reader, memory_limit, 
+                                 results_size=op.getsize(results_fn), 
+                                 vocabulary=vocabulary, **kwargs)
+    elif affinity_tiers:
+        results = ef_tiers(events_reader, results_reader, 
+                           vocabulary=vocabulary, **kwargs)
+    elif parents_fn:
+        logging.info("Event parents file: %s" % parents_fn)
+        parents_f = open(parents_fn, "r")
+        try:
+            parents = list(csv.reader(parents_f))
+        finally:
+            parents_f.close()
+        results = ef_hierarchy(events_reader, results_reader, parents, 
+                               vocabulary=vocabulary, cache_fn=cache_fn, 
+                               **kwargs)
+    elif sample_fraction:
+        results = ef_subsample(events_reader, results_reader, sample_fraction, 
+                               vocabulary=vocabulary, cache_fn=cache_fn, 
+                               **kwargs)
+    else:
+        results = ef_analysis(events_reader, results_reader, 
+                              vocabulary=vocabulary, cache_fn=cache_fn, 
+                              **kwargs)
+    try:
+        try:
+            for result in results:
+                out_writer.writerow(result)
+            if vocabulary_fn and vocabulary_sizes(vocabulary) != sizes:
+                write_vocabulary(vocabulary_fn, vocabulary)
+        except ScriptError, message:
+            logging.error(message)
+            return message.value
+    finally:
+        events_f.close()
+        results_f.close()
+        out_f.close()
+    return 0
+
+
+def plan_handler(events_fn, results_fn, out_fn, **kwargs):
+    """I/O handling for resource plans."""
+    logging.info("Events file: %s" % events_fn)
+    events_f = open(events_fn, "r")
+    events_reader = csv.reader(events_f)
+    logging.info("SEAware results file: %s" % results_fn)
+    results_f = open(results_fn, "r")
+    results_reader = csv.reader(results_f)
+    try:
+        try:
+            plan = ef_plan(events_reader, results_reader, **kwargs)
+        except ScriptError, message:
+            logging.error(message)
+            return message.value
+    finally:
+        events_f.close()
+        results_f.close()
+    logging.info("Plan file: %s" % out_fn)
+    out_f = open(out_fn, "w")
+    try:
+        json.dump(plan, out_f, indent=2, sort_keys=True)
+        out_f.write("\n")
+    finally:
+        out_f.close()
+    return 0
+
+
+def sweep_output_fn(out_fn, cutoffs):
+    """Output file name for one min-pairs, EF, and q-value combination"""
+    base, ext = op.splitext(out_fn)
+    return "%s_m%d_e%g_q%g%s" % ((base,) + tuple(cutoffs) + (ext,))
+
+
+def sweep_handler(events_fn, results_fn, out_fn, vocabulary_fn=None, 
+                  cache_dir=None, **kwargs):
+    """I/O handling for cutoff sweeps, writing one file per combination."""
+    cache_fn = None
+    if cache_dir:
+        cache_fn = incidence_cache_fn(cache_dir, events_fn, results_fn)
+    vocabulary = read_vocabulary(vocabulary_fn)
+    sizes = vocabulary_sizes(vocabulary)
+    logging.info("Events file: %s" % events_fn)
+    events_f = open(events_fn, "r")
+    events_reader = csv.reader(events_f)
+    logging.info("SEAware results file: %s" % results_fn)
+    results_f = open(results_fn, "r")
+    results_reader = csv.reader(results_f)
+    out_files = {}
+    try:
+        try:
+            for cutoffs, result in ef_sweep(events_reader, results_reader, 
+                                            vocabulary=vocabulary, 
+                                            cache_fn=cache_fn, **kwargs):
+                if cutoffs not in out_files:
+                    sweep_fn = sweep_output_fn(out_fn, cutoffs)
+                    logging.info("Output file: %s" % sweep_fn)
+                    out_f = open(sweep_fn, "w")
+                    out_files[cutoffs] = (out_f, csv.writer(out_f))
+                out_files[cutoffs][1].writerow(result)
+            if vocabulary_fn and vocabulary_sizes(vocabulary) != sizes:
+                write_vocabulary(vocabulary_fn, vocabulary)
+        except ScriptError, message:
+            logging.error(message)
+            return message.value
+    finally:
+        events_f.close()
+        results_f.close()
+        for out_f, out_writer in out_files.itervalues():
+            out_f.close()
+    return 0
+
+
+def update_handler(events_fn, results_fn, out_fn, state_fn, cache_dir=None, 
+                   **kwargs):
+    """I/O handling for the update subcommand."""
+    if cache_dir:
+        if not op.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        results_hash = cached_file_hash(cache_dir, results_fn)
+    else:
+        results_hash = file_content_hash(results_fn)
     logging.info("Events file: %s" % events_fn)
     events_f = open(events_fn, "r")
     events_reader = csv.reader(events_f)
@@ -250,8 +2603,8 @@ def handler(events_fn, results_fn, out_fn, **kwargs):
     out_writer = csv.writer(out_f)
     try:
         try:
-            for result in ef_analysis(events_reader, results_reader, 
-                                      **kwargs):
+            for result in ef_update(events_reader, results_reader, state_fn, 
+                                    results_hash, **kwargs):
                 out_writer.writerow(result)
         except ScriptError, message:
             logging.error(message)
@@ -263,12 +2616,189 @@ def handler(events_fn, results_fn, out_fn, **kwargs):
     return 0
 
 
+def add_file_logger(output_fn, log_format, log_level):
+    """Add a log file named after the output file"""
+    log_fn = output_fn.replace(".csv", "").replace(".npz", "") + ".log"
+    file_handler = logging.FileHandler(log_fn, mode="w")
+    log_formatter = logging.Formatter(log_format)
+    file_handler.setFormatter(log_formatter)
+    file_handler.setLevel(log_level)
+    root_logger = logging.getLogger()
+    root_logger.addHandler(file_handler)
+
+
+def list_type(value_type):
+    """Argument type for comma separated lists of values"""
+    def parse_list(text):
+        try:
+            return [value_type(x) for x in text.split(",")]
+        except ValueError:
+            raise ArgumentTypeError("invalid list of values: %s" % text)
+    return parse_list
+
+
+def add_output_arguments(parser, sweep=False):
+    """Add cutoff and significance arguments shared by EF outputs"""
+    if sweep:
+        int_type, float_type = list_type(int), list_type(float)
+        sweep_help = ", or comma separated values to sweep with one " + \
+                     "output file per combination"
+    else:
+        int_type, float_type = int, float
+        sweep_help = ""
+    parser.add_argument("-m", "--min-pairs", type=int_type, 
+        default=CUTOFF_MINPAIRS, 
+        help="Minimum pairs cutoff for EF analysis%s " % sweep_help + 
+             "(default: %(default)s)")
+    parser.add_argument("-e", "--ef-cutoff", type=float_type, 
+        default=CUTOFF_EF, 
+        help="Enrichment factor cutoff above which we write results" + 
+             "%s (default: %%(default)s)" % sweep_help)
+    parser.add_argument("-q", "--qvalue-cutoff", type=float_type, 
+        default=CUTOFF_QVALUE, 
+        help="Q-value cutoff below which we write results" + 
+             "%s (default: %%(default)s)" % sweep_help)
+    parser.add_argument("-b", "--bonferroni", action="store_true", 
+        help="Use Bonferroni q-value correction (saves memory at " + 
+             "high EF cutoffs while still yielding stable q-values)")
+    parser.add_argument("--test", choices=TESTS, default="chi2", 
+        help="Significance test for target-event pairs, where 'fisher' is " + 
+             "a one-sided exact test suited to low counts " + 
+             "(default: %(default)s)")
+    parser.add_argument("--qvalue-method", choices=METHODS, default="holm", 
+        help="Multiple testing correction when not using Bonferroni " + 
+             "(default: %(default)s)")
+    parser.add_argument("--max-sort-pairs", type=int, default=None, 
+        help="Maximum p-values sorted in memory for q-value correction, " + 
+             "beyond which sorted runs spill to disk (default: no limit)")
+
+
+def add_input_arguments(parser):
+    """Add the persisted ID vocabulary and parsed input cache arguments"""
+    parser.add_argument("--vocabulary", default=None, 
+        help="ID vocabulary file mapping molecule, target, and event IDs " + 
+             "to integer codes, read if present and updated with new IDs " + 
+             "(default: intern IDs anew)")
+    parser.add_argument("--cache-dir", default=None, 
+        help="directory caching parsed and pruned incidence matrices, " + 
+             "keyed by input file size, mtime, and content hash " + 
+             "(default: no cache)")
+
+
+def output_kwargs(options):
+    """Collect shared output arguments as keyword arguments"""
+    return dict(min_pairs=options.min_pairs, ef_cutoff=options.ef_cutoff, 
+                qvalue_cutoff=options.qvalue_cutoff, 
+                bonferroni=options.bonferroni, test=options.test, 
+                qvalue_method=options.qvalue_method, 
+                max_sort_pairs=options.max_sort_pairs)
+
+
+def parse_shard(text):
+    """Parse a 1-based shard specification like 2/8"""
+    try:
+        index, count = [int(x) for x in text.split("/")]
+    except ValueError:
+        raise ArgumentTypeError("shard must look like INDEX/COUNT")
+    if count < 1 or not 1 <= index <= count:
+        raise ArgumentTypeError("shard index must be from 1 to COUNT")
+    return index - 1, count
+
+
+def map_main(argv, log_format, log_level):
+    """Parse arguments for the map subcommand."""
+    description = "Compute partial EF sums for one slice of the events, " + \
+                  "to be merged by the reduce subcommand"
+    parser = ArgumentParser(prog="ef_analysis.py map", 
+                            description=description)
+    parser.add_argument("events",  
+                        help="Events file mapping molecules to events")
+    parser.add_argument("results",  
+                        help="SEAware results mapping molecules to targets")
+    parser.add_argument("output", 
+                        help="output partial-result shard (.npz) file")
+    parser.add_argument("-s", "--shard", type=parse_shard, default=None, 
+        help="only process events hashed into shard INDEX/COUNT, so " + 
+             "several map processes can share one events file " + 
+             "(default: all events)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, 
+        help="Number of processes for pair counting (default: %(default)s)")
+    add_input_arguments(parser)
+    options = parser.parse_args(args=argv[1:])
+    add_file_logger(options.output, log_format, log_level)
+    return map_handler(events_fn=options.events, results_fn=options.results, 
+                       out_fn=options.output, shard=options.shard, 
+                       jobs=options.jobs, vocabulary_fn=options.vocabulary, 
+                       cache_dir=options.cache_dir)
+
+
+def reduce_main(argv, log_format, log_level):
+    """Parse arguments for the reduce subcommand."""
+    description = "Merge partial EF shards from the map subcommand and " + \
+                  "compute enrichment factors and q-values"
+    parser = ArgumentParser(prog="ef_analysis.py reduce", 
+                            description=description)
+    parser.add_argument("output", 
+                        help="output CSV file")
+    parser.add_argument("shards", nargs="+", 
+                        help="partial-result shard files from map")
+    add_output_arguments(parser)
+    options = parser.parse_args(args=argv[1:])
+    add_file_logger(options.output, log_format, log_level)
+    return reduce_handler(shard_fns=options.shards, out_fn=options.output, 
+                          **output_kwargs(options))
+
+
+def update_main(argv, log_format, log_level):
+    """Parse arguments for the update subcommand."""
+    description = "Incrementally compute enrichment factors and q-values, " + \
+                  "recomputing only new or changed events against the " + \
+                  "target incidence kept in a state file"
+    parser = ArgumentParser(prog="ef_analysis.py update", 
+                            description=description)
+    parser.add_argument("events",  
+                        help="Events file mapping molecules to events")
+    parser.add_argument("results",  
+                        help="SEAware results mapping molecules to targets, " + 
+                             "only parsed when the state must be rebuilt")
+    parser.add_argument("output", 
+                        help="output CSV file")
+    parser.add_argument("state", 
+                        help="EF state (.npz) file, created if missing and " + 
+                             "updated in place")
+    parser.add_argument("-a", "--append", action="store_true", 
+        help="Add the events file to the events already in the state, " + 
+             "rather than treating it as the complete events feed")
+    parser.add_argument("-j", "--jobs", type=int, default=1, 
+        help="Number of processes for pair counting (default: %(default)s)")
+    parser.add_argument("--cache-dir", default=None, 
+        help="directory caching the SEAware results content hash, keyed " + 
+             "by file size and mtime (default: hash the file every run)")
+    add_output_arguments(parser)
+    options = parser.parse_args(args=argv[1:])
+    add_file_logger(options.output, log_format, log_level)
+    return update_handler(events_fn=options.events, 
+                          results_fn=options.results, out_fn=options.output, 
+                          state_fn=options.state, append=options.append, 
+                          jobs=options.jobs, cache_dir=options.cache_dir, 
+                          **output_kwargs(options))
+
+
 def main(argv):
     """Parse arguments."""
     log_level = logging.INFO
     log_format = "%(levelname)s: %(message)s"
     logging.basicConfig(level=log_level, format=log_format)
-    description = "Compute enrichment factors and q-values"
+    if len(argv) > 1 and argv[1] == "map":
+        return map_main(argv[1:], log_format, log_level)
+    if len(argv) > 1 and argv[1] == "reduce":
+        return reduce_main(argv[1:], log_format, log_level)
+    if len(argv) > 1 and argv[1] == "update":
+        return update_main(argv[1:], log_format, log_level)
+    description = "Compute enrichment factors and q-values. Use the " + \
+                  "'map' and 'reduce' subcommands to shard events " + \
+                  "across processes or machines, or 'update' to " + \
+                  "recompute only new or changed events."
     parser = ArgumentParser(description=description)
     parser.add_argument("events",  
                         help="Events file mapping molecules to events")
@@ -276,34 +2806,114 @@ def main(argv):
                         help="SEAware results mapping molecules to targets")
     parser.add_argument("output", 
                         help="output CSV file")
-    parser.add_argument("-m", "--min-pairs", type=int, default=CUTOFF_MINPAIRS, 
-        help="Minimum pairs cutoff for EF analysis (default: %(default)s)")
-    parser.add_argument("-e", "--ef-cutoff", type=float, default=CUTOFF_EF, 
-        help="Enrichment factor cutoff above which we write results " + 
-             "(default: %(default)s)")
-    parser.add_argument("-q", "--qvalue-cutoff", type=float, 
-        default=CUTOFF_QVALUE, 
-        help="Q-value cutoff below which we write results " + 
-             "(default: %(default)s)")
-    parser.add_argument("-b", "--bonferroni", action="store_true", 
-        help="Use Bonferroni q-value correction (saves memory at " + 
-             "high EF cutoffs while still yielding stable q-values)")
+    add_output_arguments(parser, sweep=True)
+    parser.add_argument("--engine", choices=ENGINES, default="sparse", 
+        help="EF engine, where 'sets' is the original set intersection " + 
+             "reference (default: %(default)s)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, 
+        help="Number of processes for EF computation, splitting events " + 
+             "across a process pool (default: %(default)s)")
+    parser.add_argument("--memory-limit", type=int, default=None, 
+        help="Memory limit in MB for out-of-core mode, which partitions " + 
+             "SEAware results by target into temporary files under " + 
+             "TMPDIR (default: read all results into memory)")
+    parser.add_argument("--sample-fraction", type=float, default=None, 
+        help="Approximate mode, screening pairs with counts from repeated " + 
+             "seeded subsamples of this fraction of molecules, and " + 
+             "computing exact EFs, p-values, and q-values only for pairs " + 
+             "whose upper count bound reaches the min-pairs cutoff " + 
+             "(default: exact)")
+    parser.add_argument("--sample-repeats", type=int, default=SAMPLE_REPEATS, 
+        help="Number of subsamples for EF intervals (default: %(default)s)")
+    parser.add_argument("--bootstrap", type=int, default=None, 
+        help="Number of bootstrap resamples of molecules for percentile " + 
+             "EF intervals, written as extra columns for reported pairs " + 
+             "(default: no intervals)")
+    parser.add_argument("--null-clusters", type=int, default=None, 
+        help="Number of random clusters per event size bin, sized like " + 
+             "the events in the bin and scored against every target as " + 
+             "an empirical EF null, writing a null_p column for reported " + 
+             "pairs (default: no null)")
+    parser.add_argument("-r", "--random-seed", type=int, default=SAMPLE_SEED, 
+        help="Random seed for subsamples, bootstrap resamples, and " + 
+             "random clusters (default: %(default)s)")
+    parser.add_argument("--affinity-tiers", action="store_true", 
+        help="Compute EFs for every cumulative affinity tier of the " + 
+             "SEAware results, from tightest to loosest, with a tier " + 
+             "column in the output (default: union of all affinities)")
+    parser.add_argument("--event-parents", default=None, 
+        help="CSV file mapping events to parent events, rolling events " + 
+             "up to every level of the hierarchy with a level column in " + 
+             "the output, where 0 is the events file itself " + 
+             "(default: no roll-up)")
+    parser.add_argument("--plan", action="store_true", 
+        help="Only count events, targets, molecules, and candidate pairs, " + 
+             "and write estimated memory and runtime per engine as JSON " + 
+             "to the output file")
+    add_input_arguments(parser)
     options = parser.parse_args(args=argv[1:])
-    # Add file logger
-    log_fn = options.output.replace(".csv", "") + ".log"
-    file_handler = logging.FileHandler(log_fn, mode="w")
-    log_formatter = logging.Formatter(log_format)
-    file_handler.setFormatter(log_formatter)
-    file_handler.setLevel(log_level)
-    root_logger = logging.getLogger()
-    root_logger.addHandler(file_handler)
+    add_file_logger(options.output, log_format, log_level)
+    kwargs = output_kwargs(options)
+    cutoff_names = ("min_pairs", "ef_cutoff", "qvalue_cutoff")
+    for name in cutoff_names:
+        if not isinstance(kwargs[name], list):
+            kwargs[name] = [kwargs[name]]
+    if options.plan:
+        return plan_handler(events_fn=options.events, 
+                            results_fn=options.results, 
+                            out_fn=options.output, 
+                            min_pairs=min(kwargs["min_pairs"]), 
+                            jobs=options.jobs, test=options.test)
+    if any(len(kwargs[name]) > 1 for name in cutoff_names):
+        if options.engine != "sparse":
+            logging.error("Cutoff sweeps require the sparse EF engine")
+            return 2
+        if options.memory_limit:
+            logging.error("Cutoff sweeps do not support out-of-core mode")
+            return 2
+        if options.bootstrap or options.null_clusters or \
+                options.affinity_tiers or options.event_parents:
+            logging.error("Cutoff sweeps do not support bootstrap " 
+                          "intervals, empirical nulls, affinity tiers, or " 
+                          "event hierarchies")
+            return 2
+        return sweep_handler(events_fn=options.events, 
+                             results_fn=options.results, 
+                             out_fn=options.output, jobs=options.jobs, 
+                             vocabulary_fn=options.vocabulary, 
+                             cache_dir=options.cache_dir, **kwargs)
+    for name in cutoff_names:
+        kwargs[name] = kwargs[name][0]
+    if options.sample_fraction:
+        if options.memory_limit:
+            logging.error("Subsampling does not support out-of-core mode")
+            return 2
+        kwargs.update(sample_fraction=options.sample_fraction, 
+                      sample_repeats=options.sample_repeats, 
+                      random_seed=options.random_seed)
+    if options.affinity_tiers or options.event_parents:
+        if options.memory_limit or options.sample_fraction or \
+                options.bootstrap or options.null_clusters or \
+                (options.affinity_tiers and options.event_parents):
+            logging.error("Affinity tiers and event hierarchies only " 
+                          "support the exact in-memory mode on their own")
+            return 2
+        kwargs.update(affinity_tiers=options.affinity_tiers, 
+                      parents_fn=options.event_parents)
+    if options.bootstrap or options.null_clusters:
+        if options.memory_limit or options.sample_fraction:
+            logging.error("Bootstrap intervals and empirical nulls require " 
+                          "the exact in-memory mode")
+            return 2
+        kwargs.update(bootstrap=options.bootstrap, 
+                      null_clusters=options.null_clusters, 
+                      random_seed=options.random_seed)
     return handler(events_fn=options.events, results_fn=options.results, 
-                   out_fn=options.output, min_pairs=options.min_pairs, 
-                   ef_cutoff=options.ef_cutoff, 
-                   qvalue_cutoff=options.qvalue_cutoff, 
-                   bonferroni=options.bonferroni)
+                   out_fn=options.output, engine=options.engine, 
+                   jobs=options.jobs, vocabulary_fn=options.vocabulary, 
+                   cache_dir=options.cache_dir, 
+                   memory_limit=options.memory_limit, **kwargs)
 
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
-
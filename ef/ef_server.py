@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+"""
+Copyright (C) 2015 Michael M Mysinger
+
+Serve EF analyses over localhost HTTP, holding SEAware results in memory.
+
+POST events CSV rows (molecule,event), or a JSON object mapping events to
+molecule lists, to /ef with cutoffs as query parameters; the response is
+the ef_analysis CSV output. Use the 'query' subcommand as a client.
+"""
+
+import os
+import sys
+import logging
+import os.path as op
+from argparse import ArgumentParser
+
+import csv
+import json
+import urllib
+import urllib2
+import urlparse
+from array import array
+from cStringIO import StringIO
+from collections import namedtuple
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import numpy as np
+
+module_path = os.path.realpath(os.path.dirname(__file__))
+labware_path = os.path.join(module_path, "..")
+sys.path.append(labware_path)
+from libraries.lab_utils import ScriptError, gopen, Interner
+from ef.ef_analysis import CUTOFF_MINPAIRS, CUTOFF_EF, CUTOFF_QVALUE, \
+    Incidence, new_vocabulary, read_result_codes, edges_to_matrix, \
+    compute_efs_sparse, map_contingency_tables_sparse, validate_options, \
+    log_cutoffs, tested_contingencies, ef_results, add_file_logger, \
+    add_output_arguments, output_kwargs
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+QUERY_TYPES = {"min_pairs": int, "ef_cutoff": float, "qvalue_cutoff": float,
+               "bonferroni": lambda x: x.lower() in ("1", "true", "yes"),
+               "test": str, "qvalue_method": str, "max_sort_pairs": int}
+
+TargetLibrary = namedtuple("TargetLibrary",
+                           "molecules target_ids targets drug_targets")
+
+
+def load_library(results_reader):
+    """Read SEAware results for every molecule into a target library"""
+    vocabulary = new_vocabulary()
+    target_edges, has_target, targets = read_result_codes(results_reader,
+                                                          vocabulary)
+    molecules = vocabulary["molecule"]
+    target_ids = vocabulary["target"]
+    # Row slicing by query molecules is fastest in CSR
+    drug_targets = edges_to_matrix(target_edges[0], target_edges[1],
+        (len(molecules), len(target_ids))).tocsr()
+    logging.info("Holding %d drug-target pairs for %d molecules in memory" %
+                 (drug_targets.nnz, len(molecules)))
+    return TargetLibrary(molecules, target_ids, targets, drug_targets)
+
+
+def query_incidence(library, event_rows):
+    """Build pruned incidence for query events over library molecules"""
+    events = Interner()
+    drug_codes = array("i")
+    event_codes = array("i")
+    pruned = set()
+    for cid, eid in event_rows:
+        event = events.intern(eid)
+        code = library.molecules.get(cid)
+        if code is None:
+            pruned.add(cid)
+            continue
+        drug_codes.append(code)
+        event_codes.append(event)
+    drug_codes = np.frombuffer(drug_codes, dtype=np.int32)
+    event_codes = np.frombuffer(event_codes, dtype=np.int32)
+    logging.info("Pruned %d event molecules that were not mapped to targets" %
+                 len(pruned))
+    # Only queried molecules matter, so restrict the library to their rows
+    drugs, local_codes = np.unique(drug_codes, return_inverse=True)
+    drug_events = edges_to_matrix(local_codes, event_codes,
+                                  (len(drugs), len(events)))
+    drug_targets = library.drug_targets[drugs].tocsc()
+    logging.info("Query holds %d drug-event pairs for %d events and %d "
+                 "molecules" % (drug_events.nnz, len(events), len(drugs)))
+    return Incidence([library.molecules[i] for i in drugs], events.names,
+                     library.target_ids.names, drug_events, drug_targets)
+
+
+def query_efs(library, event_rows, min_pairs=CUTOFF_MINPAIRS,
+              ef_cutoff=CUTOFF_EF, qvalue_cutoff=CUTOFF_QVALUE,
+              bonferroni=False, test="chi2", qvalue_method="holm",
+              max_sort_pairs=None, jobs=1):
+    """Compute enrichment factors and q-values for one query."""
+    validate_options(test=test, qvalue_method=qvalue_method)
+    log_cutoffs(min_pairs, ef_cutoff, qvalue_cutoff)
+    incidence = query_incidence(library, event_rows)
+    efs = compute_efs_sparse(incidence, min_pairs=min_pairs, jobs=jobs)
+    efs, contingencies, bonferroni_count = tested_contingencies(efs,
+        lambda efs: map_contingency_tables_sparse(efs, incidence),
+        bonferroni=bonferroni, ef_cutoff=ef_cutoff)
+    for row in ef_results(efs, contingencies, incidence.events,
+                          incidence.targets, library.targets,
+                          ef_cutoff=ef_cutoff, qvalue_cutoff=qvalue_cutoff,
+                          bonferroni_count=bonferroni_count, test=test,
+                          qvalue_method=qvalue_method,
+                          max_sort_pairs=max_sort_pairs):
+        yield row
+
+
+def parse_event_rows(body, content_type):
+    """Parse events CSV rows or a JSON events to molecules mapping"""
+    if content_type.startswith("application/json"):
+        events_to_drugs = json.loads(body)
+        if not isinstance(events_to_drugs, dict) or not all(
+                isinstance(cids, list) for cids in events_to_drugs.values()):
+            raise ScriptError("JSON events must map each event to a list "
+                              "of molecules", 2)
+        return [(str(cid), str(eid)) for eid, cids in
+                events_to_drugs.iteritems() for cid in cids]
+    try:
+        rows = [row for row in csv.reader(StringIO(body)) if row]
+    except csv.Error, message:
+        raise ScriptError("Invalid events CSV: %s" % message, 2)
+    for row in rows:
+        if len(row) < 2:
+            raise ScriptError("Too few fields in events at row: %s" % row, 2)
+    return [tuple(row[:2]) for row in rows]
+
+
+def parse_query(query):
+    """Convert URL query parameters into query_efs keyword arguments"""
+    kwargs = {}
+    for name, value in urlparse.parse_qsl(query):
+        if name not in QUERY_TYPES:
+            raise ScriptError("Unknown query parameter: %s" % name, 2)
+        try:
+            kwargs[name] = QUERY_TYPES[name](value)
+        except ValueError:
+            raise ScriptError("Invalid %s: %s" % (name, value), 2)
+    return kwargs
+
+
+class EFRequestHandler(BaseHTTPRequestHandler):
+    """Answer EF queries against the server's target library"""
+
+    def log_message(self, format, *args):
+        logging.info("%s - %s" % (self.address_string(), format % args))
+
+    def send_text(self, text, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def do_GET(self):
+        if urlparse.urlparse(self.path).path != "/status":
+            self.send_error(404, "Unknown path: %s" % self.path)
+            return
+        library = self.server.library
+        self.send_text(json.dumps({"molecules": len(library.molecules),
+                                   "targets": len(library.target_ids),
+                                   "drug_targets": library.drug_targets.nnz}),
+                       "application/json")
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != "/ef":
+            self.send_error(404, "Unknown path: %s" % url.path)
+            return
+        try:
+            kwargs = parse_query(url.query)
+            # Events only come from the request body, so clients can never
+            # name files on the server
+            length = int(self.headers.get("Content-Length", 0))
+            event_rows = parse_event_rows(self.rfile.read(length),
+                self.headers.get("Content-Type", "text/csv"))
+            out_f = StringIO()
+            out_writer = csv.writer(out_f)
+            for result in query_efs(self.server.library, event_rows,
+                                    jobs=self.server.jobs, **kwargs):
+                out_writer.writerow(result)
+        except (ScriptError, ValueError), message:
+            logging.error(message)
+            self.send_error(400, str(message))
+            return
+        self.send_text(out_f.getvalue(), "text/csv")
+
+
+def serve(results_fn, host=DEFAULT_HOST, port=DEFAULT_PORT, jobs=1):
+    """Load SEAware results once and answer EF queries until interrupted"""
+    logging.info("SEAware results file: %s" % results_fn)
+    results_f = gopen(results_fn)
+    try:
+        library = load_library(csv.reader(results_f))
+    finally:
+        results_f.close()
+    server = HTTPServer((host, port), EFRequestHandler)
+    server.library = library
+    server.jobs = jobs
+    logging.info("Serving EF queries on http://%s:%d/ef" % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Shutting down")
+    finally:
+        server.server_close()
+    return 0
+
+
+def query_handler(events_fn, out_fn, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                  **kwargs):
+    """I/O handling for the query subcommand."""
+    params = dict((name, value) for name, value in kwargs.iteritems()
+                  if value is not None)
+    params["bonferroni"] = int(params.get("bonferroni", False))
+    url = "http://%s:%d/ef?%s" % (host, port, urllib.urlencode(params))
+    logging.info("Events file: %s" % events_fn)
+    events_f = gopen(events_fn)
+    try:
+        body = events_f.read()
+    finally:
+        events_f.close()
+    logging.info("Querying %s" % url)
+    request = urllib2.Request(url, body, {"Content-Type": "text/csv"})
+    try:
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError, error:
+        logging.error("EF server error %d: %s" % (error.code, error.msg))
+        return 1
+    except urllib2.URLError, error:
+        logging.error("Could not reach EF server: %s" % error.reason)
+        return 1
+    logging.info("Output file: %s" % out_fn)
+    out_f = open(out_fn, "w")
+    try:
+        out_f.write(response.read())
+    finally:
+        out_f.close()
+    return 0
+
+
+def add_server_arguments(parser):
+    """Add the host and port arguments shared by server and client"""
+    parser.add_argument("--host", default=DEFAULT_HOST,
+                        help="server host (default: %(default)s)")
+    parser.add_argument("-p", "--port", type=int, default=DEFAULT_PORT,
+                        help="server port (default: %(default)s)")
+
+
+def query_main(argv, log_format, log_level):
+    """Parse arguments for the query subcommand."""
+    description = "Send an events file to a running EF server and save " + \
+                  "the EF analysis output"
+    parser = ArgumentParser(prog="ef_server.py query",
+                            description=description)
+    parser.add_argument("events",
+                        help="Events file mapping molecules to events")
+    parser.add_argument("output",
+                        help="output CSV file")
+    add_server_arguments(parser)
+    add_output_arguments(parser)
+    options = parser.parse_args(args=argv[1:])
+    add_file_logger(options.output, log_format, log_level)
+    return query_handler(events_fn=options.events, out_fn=options.output,
+                         host=options.host, port=options.port,
+                         **output_kwargs(options))
+
+
+def main(argv):
+    """Parse arguments."""
+    log_level = logging.INFO
+    log_format = "%(levelname)s: %(message)s"
+    logging.basicConfig(level=log_level, format=log_format)
+    if len(argv) > 1 and argv[1] == "query":
+        return query_main(argv[1:], log_format, log_level)
+    description = "Serve EF analyses over localhost HTTP, loading SEAware " + \
+                  "results only once. Use the 'query' subcommand to send " + \
+                  "events files to a running server."
+    parser = ArgumentParser(description=description)
+    parser.add_argument("results",
+                        help="SEAware results mapping molecules to targets")
+    add_server_arguments(parser)
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+        help="Number of processes for pair counting (default: %(default)s)")
+    options = parser.parse_args(args=argv[1:])
+    return serve(options.results, host=options.host, port=options.port,
+                 jobs=options.jobs)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -4,6 +4,12 @@ Copyright (C) 2015 Michael M Mysinger
 
 Compute pairs of targets for target-target to event EF analysis.
 
+Target pairs sharing at least min-pairs molecules come from blocks of the
+sparse targets x molecules self-product, so only qualifying pairs are ever
+materialized, and each is written with the SEA results of its shared
+molecules against both targets. The 'ef' subcommand instead treats each
+pair's shared molecules as a pseudo-target for EF analysis against events.
+
 Michael Mysinger 201510 Created
 """
 
@@ -14,64 +20,328 @@ import os.path as op
 from argparse import ArgumentParser
 
 import csv
-from collections import defaultdict
+import time
+from array import array
+from collections import namedtuple
+import numpy as np
+from scipy import sparse
 
-module_path = os.path.realpath(os.path.dirname(__file__)) 
+module_path = os.path.realpath(os.path.dirname(__file__))
 labware_path = os.path.join(module_path, "..")
 sys.path.append(labware_path)
-from libraries.lab_utils import ScriptError, gopen
+from libraries.lab_utils import ScriptError, gopen, Interner
+from ef.ef_analysis import CUTOFF_EF, CUTOFF_QVALUE, EFTable, \
+    ContingencySums, StageTimer, read_incidence, contingencies_from_sums, \
+    tested_contingencies, validate_options, log_cutoffs, ef_results, \
+    add_output_arguments, add_input_arguments, output_kwargs, \
+    add_file_logger, read_vocabulary, write_vocabulary, vocabulary_sizes, \
+    incidence_cache_fn
 
 
 CUTOFF_MINPAIRS = 4       # Nat2012: Target-ADR pairs > 10 retained
+PAIR_BLOCK = 256
+EF_PAIR_BLOCK = 4096
+PAIR_SEP = "|"
 
 Target = namedtuple("Target", "name description")
+TargetResults = namedtuple("TargetResults", "target_ids molecule_ids "
+                           "smiles targets target_drugs edges pvalues maxtcs")
 
 
 def read_results(results_reader):
-    """Read targets to molecules mapping"""
+    """Read targets to molecules mapping with SEA results per pair"""
     logging.info("Reading targets")
     header = results_reader.next()
     logging.info("Skipping SEAware results header: %s" % str(header))
-    molecules = {}
+    molecules = Interner()
+    target_ids = Interner()
+    smiles_list = []
     targets = {}
-    targets_to_drugs = defaultdict(set)
+    best = {}
     for row in results_reader:
         if len(row) == 8:
             cid, smiles, tid, affinity, pvalue, maxtc, name, desc = row
-            mol_extra = []
         elif len(row) > 8:
             cid, tid, affinity, pvalue, maxtc, name, desc, smiles = row[:8]
-            mol_extra = row[8:]
-        if cid not in molecules:
-            molecules[cid] = (smiles, mol_extra)
+        else:
+            raise ScriptError("Too few fields in results file at row: %s" %
+                              row, 11)
+        code = molecules.intern(cid)
+        if code == len(smiles_list):
+            smiles_list.append(smiles)
         if tid not in targets:
             targets[tid] = Target(name, desc)
-        # implicitly takes the union over remaining affinity groups
-        targets_to_drugs[tid].add(cid, affinity, pvalue, maxtc)
-    logging.info("Read %d targets" % len(targets_to_drugs))
-    return targets_to_drugs, molecules, targets
+        # Takes the union over affinity groups, keeping the best SEA result
+        key = (target_ids.intern(tid), code)
+        pvalue, maxtc = float(pvalue), float(maxtc)
+        if key not in best or pvalue < best[key][0]:
+            best[key] = (pvalue, maxtc)
+    logging.info("Read %d targets for %d molecules" % (len(targets),
+                                                        len(molecules.names)))
+    # Rows follow sorted target IDs, so pairs come out in name order
+    order = np.argsort(target_ids.names)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    rows = array("i")
+    cols = array("i")
+    pvalues = array("d")
+    maxtcs = array("d")
+    for (target, code), (pvalue, maxtc) in best.iteritems():
+        rows.append(rank[target])
+        cols.append(code)
+        pvalues.append(pvalue)
+        maxtcs.append(maxtc)
+    del best
+    shape = (len(order), len(molecules.names))
+    # Edge numbers are offset by one, so stored zeros never drop out
+    edges = sparse.coo_matrix((np.arange(1, len(rows) + 1),
+                               (np.frombuffer(rows, dtype=np.int32),
+                                np.frombuffer(cols, dtype=np.int32))),
+                              shape=shape).tocsr()
+    edges.sort_indices()
+    target_drugs = edges.copy()
+    target_drugs.data = np.ones(len(target_drugs.data), dtype=np.int32)
+    return TargetResults([target_ids.names[i] for i in order],
+                         molecules.names, smiles_list, targets, target_drugs,
+                         edges, np.frombuffer(pvalues, dtype=np.float64),
+                         np.frombuffer(maxtcs, dtype=np.float64))
+
+
+def shared_pair_blocks(target_drugs, min_pairs=CUTOFF_MINPAIRS,
+                       block_size=PAIR_BLOCK):
+    """Yield (first, second, counts) for target pairs sharing at least
+    min_pairs molecules, one block of first targets at a time"""
+    num_targets = target_drugs.shape[0]
+    drug_targets = target_drugs.T.tocsc()
+    for start in xrange(0, num_targets, block_size):
+        stop = min(start + block_size, num_targets)
+        counts = target_drugs[start:stop].dot(drug_targets).tocoo()
+        first = counts.row + start
+        # Each unordered pair once, skipping targets paired with themselves
+        keep = (counts.col > first) & (counts.data >= max(min_pairs, 1))
+        first, second = first[keep], counts.col[keep]
+        order = np.lexsort((second, first))
+        yield first[order], second[order], counts.data[keep][order]
+
+
+def shared_edges(results, first, second):
+    """Shared molecules of each pair with their edges to both targets"""
+    shared = results.target_drugs[first].multiply(
+        results.target_drugs[second]).tocsr()
+    shared.sort_indices()
+    first_edges = results.edges[first].multiply(shared).tocsr()
+    second_edges = results.edges[second].multiply(shared).tocsr()
+    first_edges.sort_indices()
+    second_edges.sort_indices()
+    pairs = np.repeat(np.arange(len(first)), np.diff(shared.indptr))
+    return pairs, shared.indices, first_edges.data - 1, second_edges.data - 1
 
 
-def gen_pairs(results_reader, min_pairs=CUTOFF_MINPAIRS):
+def gen_pairs(results_reader, min_pairs=CUTOFF_MINPAIRS,
+              block_size=PAIR_BLOCK):
     """Compute pairs of targets for target-target to event EF analysis"""
     logging.info("Using min-pairs cutoff = %d" % min_pairs)
-    targets_to_drugs, molecules, targets = read_results(results_reader)
+    results = read_results(results_reader)
+    logging.info("Computing shared molecules for %d targets in blocks of %d" %
+                 (len(results.target_ids), block_size))
+    yield ["target id 1", "target id 2", "molecule id", "smiles",
+           "p-value 1", "max tc 1", "p-value 2", "max tc 2"]
+    num_pairs = 0
+    for first, second, counts in shared_pair_blocks(results.target_drugs,
+                                                    min_pairs, block_size):
+        num_pairs += len(first)
+        pairs, drugs, first_edges, second_edges = shared_edges(results,
+                                                               first, second)
+        for i, drug, a, b in zip(pairs, drugs, first_edges, second_edges):
+            yield [results.target_ids[first[i]],
+                   results.target_ids[second[i]],
+                   results.molecule_ids[drug], results.smiles[drug],
+                   "%.3g" % results.pvalues[a], "%.2f" % results.maxtcs[a],
+                   "%.3g" % results.pvalues[b], "%.2f" % results.maxtcs[b]]
+    logging.info("Wrote %d target pairs sharing at least %d molecules" %
+                 (num_pairs, min_pairs))
+
+
+class PairNames(object):
+    """Target pair IDs, only joined into strings for written rows, with
+    the two target IDs sorted like the gen_pairs output"""
+
+    def __init__(self, target_names, first, second):
+        self.target_names = target_names
+        self.first = first
+        self.second = second
+
+    def __len__(self):
+        return len(self.first)
+
+    def __getitem__(self, i):
+        return PAIR_SEP.join(sorted([self.target_names[self.first[i]],
+                                     self.target_names[self.second[i]]]))
 
-# Psuedo-code
-#   Create target -> cid mapping with sea results along for the ride
-#   Consider all target pairs (sort pair name alphabetically?)
-#       If number of common drugs in target pair > min_pairs
-#           Write out those drugs results
 
+class PairTargets(object):
+    """Target names and descriptions for pair IDs, joined on lookup"""
 
+    def __init__(self, targets):
+        self.targets = targets
 
+    def __getitem__(self, pair_id):
+        first, second = [self.targets[tid] for tid in
+                         pair_id.split(PAIR_SEP)]
+        return Target(first.name + PAIR_SEP + second.name,
+                      first.description + PAIR_SEP + second.description)
 
-def handler(events_fn, results_fn, out_fn, **kwargs):
+
+def enumerate_pairs(target_drugs, min_pairs=CUTOFF_MINPAIRS):
+    """Target pairs sharing at least min_pairs molecules, and the number
+    of those pairs each molecule belongs to"""
+    firsts = []
+    seconds = []
+    pair_counts = np.zeros(target_drugs.shape[1], dtype=np.int64)
+    for first, second, counts in shared_pair_blocks(target_drugs, min_pairs):
+        firsts.append(first)
+        seconds.append(second)
+        shared = target_drugs[first].multiply(target_drugs[second])
+        pair_counts += np.asarray(shared.sum(axis=0), dtype=np.int64).ravel()
+    if not firsts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), \
+               pair_counts
+    return np.concatenate(firsts), np.concatenate(seconds), pair_counts
+
+
+def ef_target_pairs(events_reader, results_reader, min_pairs=CUTOFF_MINPAIRS,
+                    min_shared=CUTOFF_MINPAIRS, ef_cutoff=CUTOFF_EF,
+                    qvalue_cutoff=CUTOFF_QVALUE, bonferroni=False,
+                    test="chi2", qvalue_method="holm", max_sort_pairs=None,
+                    block_size=EF_PAIR_BLOCK, vocabulary=None, cache_fn=None):
+    """Compute EFs and q-values of target pairs against events.
+
+    Pairs sharing at least min_shared result molecules form the same
+    background as the plain gen_pairs output, while min_pairs only selects
+    the pair-event pairs to test, as in ef_analysis.
+    """
+    if min_pairs < 1:
+        raise ScriptError("Target pairs require a min-pairs cutoff of at "
+                          "least 1", 2)
+    validate_options(test=test, qvalue_method=qvalue_method)
+    logging.info("Using min-shared cutoff = %d" % min_shared)
+    log_cutoffs(min_pairs, ef_cutoff, qvalue_cutoff)
+    timer = StageTimer()
+    incidence, targets = read_incidence(events_reader, results_reader,
+                                        vocabulary=vocabulary,
+                                        cache_fn=cache_fn,
+                                        prune_results=False)
+    timer("input")
+    # Pairs come from every result molecule, as in the plain gen_pairs output
+    target_drugs = incidence.drug_targets.T.tocsr()
+    first, second, pair_counts = enumerate_pairs(target_drugs, min_shared)
+    num_pairs = len(first)
+    logging.info("Found %d target pairs sharing at least %d molecules" %
+                 (num_pairs, min_shared))
+    timer("pair enumeration")
+    # Pair pseudo-targets replace targets in E, P, and contingency sums
+    # Row major events suit the pairs x molecules products best
+    drug_events = incidence.drug_events.tocsr()
+    event_counts = np.diff(drug_events.indptr)
+    # Only molecules mapped to events count towards the background
+    pair_counts = pair_counts * (event_counts > 0)
+    E = drug_events.T.dot(pair_counts)
+    P = int((pair_counts * event_counts).sum())
+    total = int(pair_counts.sum())
+    weighted_events = sparse.diags(pair_counts, 0).dot(drug_events).tocsr()
+    T = np.zeros(num_pairs, dtype=np.int64)
+    target_sums = np.zeros(num_pairs, dtype=np.int64)
+    blocks = []
+    start_time = time.time()
+    for start in xrange(0, num_pairs, block_size):
+        stop = min(start + block_size, num_pairs)
+        shared = target_drugs[first[start:stop]].multiply(
+            target_drugs[second[start:stop]]).tocsr()
+        counts = shared.dot(drug_events).tocsr()
+        T[start:stop] = shared.dot(event_counts)
+        target_sums[start:stop] = shared.dot(pair_counts)
+        # Shared molecules all belong to a pair, so both has the same
+        # sparsity structure as counts and their sorted entries align
+        both = shared.dot(weighted_events).tocsr()
+        counts.sort_indices()
+        both.sort_indices()
+        keep = counts.data >= min_pairs
+        rows = np.repeat(np.arange(start, stop), np.diff(counts.indptr))
+        blocks.append((counts.indices[keep], rows[keep], counts.data[keep],
+                       both.data[keep].astype(np.int64)))
+    elapsed = max(time.time() - start_time, 1e-6)
+    logging.info("Counted events for %d target pairs at %.0f pairs per "
+                 "second" % (num_pairs, num_pairs / elapsed))
+    if blocks:
+        rows, cols, pte, both = [np.concatenate(x) for x in zip(*blocks)]
+    else:
+        rows = cols = pte = both = np.zeros(0, dtype=np.int64)
+    del blocks
+    # Same operation order as ef_analysis, so EFs agree for real targets
+    efs = pte.astype(np.float64) / (E[rows] * T[cols])
+    efs = EFTable(rows, cols, pte, efs * P)
+    logging.info("Computed %d pair-event enrichment factors" % len(efs.efs))
+    timer("enrichment factors")
+    sums = ContingencySums(sparse.csr_matrix((both, (rows, cols)),
+                                             shape=(len(E), num_pairs)),
+                           E, target_sums, total)
+    del both
+    efs, contingencies, bonferroni_count = tested_contingencies(efs,
+        lambda efs: contingencies_from_sums(efs, sums),
+        bonferroni=bonferroni, ef_cutoff=ef_cutoff)
+    timer("contingency tables")
+    for row in ef_results(efs, contingencies, incidence.events,
+                          PairNames(incidence.targets, first, second),
+                          PairTargets(targets), ef_cutoff=ef_cutoff,
+                          qvalue_cutoff=qvalue_cutoff,
+                          bonferroni_count=bonferroni_count, test=test,
+                          qvalue_method=qvalue_method,
+                          max_sort_pairs=max_sort_pairs, timer=timer):
+        yield row
+
+
+def ef_handler(events_fn, results_fn, out_fn, vocabulary_fn=None,
+               cache_dir=None, **kwargs):
+    """I/O handling for the ef subcommand."""
+    cache_fn = None
+    if cache_dir:
+        cache_fn = incidence_cache_fn(cache_dir, events_fn, results_fn,
+                                      prune_results=False)
+    vocabulary = read_vocabulary(vocabulary_fn)
+    sizes = vocabulary_sizes(vocabulary)
+    logging.info("Events file: %s" % events_fn)
+    events_f = gopen(events_fn)
+    events_reader = csv.reader(events_f)
+    logging.info("SEAware results file: %s" % results_fn)
+    results_f = gopen(results_fn)
+    results_reader = csv.reader(results_f)
+    out_f = gopen(out_fn, "w")
+    logging.info("Output file: %s" % out_fn)
+    out_writer = csv.writer(out_f)
+    try:
+        try:
+            for result in ef_target_pairs(events_reader, results_reader,
+                                          vocabulary=vocabulary,
+                                          cache_fn=cache_fn, **kwargs):
+                out_writer.writerow(result)
+            if vocabulary_fn and vocabulary_sizes(vocabulary) != sizes:
+                write_vocabulary(vocabulary_fn, vocabulary)
+        except ScriptError, message:
+            logging.error(message)
+            return message.value
+    finally:
+        events_f.close()
+        results_f.close()
+        out_f.close()
+    return 0
+
+
+def handler(results_fn, out_fn, **kwargs):
     """I/O handling for the script."""
     logging.info("SEAware results file: %s" % results_fn)
-    results_f = open(results_fn, "r")
+    results_f = gopen(results_fn)
     results_reader = csv.reader(results_f)
-    out_f = open(out_fn, "w")
+    out_f = gopen(out_fn, "w")
     logging.info("Output file: %s" % out_fn)
     out_writer = csv.writer(out_f)
     try:
@@ -87,19 +357,55 @@ def handler(events_fn, results_fn, out_fn, **kwargs):
     return 0
 
 
+def ef_main(argv, log_format, log_level):
+    """Parse arguments for the ef subcommand."""
+    description = "Compute enrichment factors and q-values of target " + \
+                  "pairs against events, using the molecules each pair " + \
+                  "shares as a pseudo-target"
+    parser = ArgumentParser(prog="gen_pairs.py ef", description=description)
+    parser.add_argument("events",
+                        help="Events file mapping molecules to events")
+    parser.add_argument("results",
+                        help="SEAware results mapping molecules to targets")
+    parser.add_argument("output",
+                        help="output CSV file")
+    add_output_arguments(parser)
+    parser.add_argument("--min-shared", type=int, default=CUTOFF_MINPAIRS,
+        help="Minimum shared molecules for target pair creation, as in " +
+             "plain gen_pairs -m (default: %(default)s)")
+    parser.add_argument("--block-size", type=int, default=EF_PAIR_BLOCK,
+        help="Target pairs per block of pair-event counts, bounding " +
+             "memory (default: %(default)s)")
+    add_input_arguments(parser)
+    options = parser.parse_args(args=argv[1:])
+    add_file_logger(options.output, log_format, log_level)
+    return ef_handler(events_fn=options.events, results_fn=options.results,
+                      out_fn=options.output, min_shared=options.min_shared,
+                      block_size=options.block_size,
+                      vocabulary_fn=options.vocabulary,
+                      cache_dir=options.cache_dir, **output_kwargs(options))
+
+
 def main(argv):
     """Parse arguments."""
     log_level = logging.INFO
     log_format = "%(levelname)s: %(message)s"
     logging.basicConfig(level=log_level, format=log_format)
-    description = "Compute pairs of targets for target-target to event EF analysis."
+    if len(argv) > 1 and argv[1] == "ef":
+        return ef_main(argv[1:], log_format, log_level)
+    description = "Compute pairs of targets for target-target to event " + \
+                  "EF analysis. Use the 'ef' subcommand to compute the " + \
+                  "target pair EFs against events."
     parser = ArgumentParser(description=description)
-    parser.add_argument("results",  
+    parser.add_argument("results",
                         help="SEAware results mapping molecules to targets")
-    parser.add_argument("output", 
+    parser.add_argument("output",
                         help="output target pairs CSV file")
-    parser.add_argument("-m", "--min-pairs", type=int, default=CUTOFF_MINPAIRS, 
+    parser.add_argument("-m", "--min-pairs", type=int, default=CUTOFF_MINPAIRS,
         help="Minimum pairs cutoff for target pair creation (default: %(default)s)")
+    parser.add_argument("--block-size", type=int, default=PAIR_BLOCK,
+        help="Targets per block of the sparse self-product, bounding " +
+             "memory (default: %(default)s)")
     options = parser.parse_args(args=argv[1:])
     # Add file logger
     log_fn = options.output.replace(".csv", "") + ".log"
@@ -109,10 +415,10 @@ def main(argv):
     file_handler.setLevel(log_level)
     root_logger = logging.getLogger()
     root_logger.addHandler(file_handler)
-    return handler(results_fn=options.results, 
-                   out_fn=options.output, min_pairs=options.min_pairs)
+    return handler(results_fn=options.results,
+                   out_fn=options.output, min_pairs=options.min_pairs,
+                   block_size=options.block_size)
 
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
-
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Copyright (C) 2015 Michael M Mysinger
+
+Randomize events while preserving drug and event degrees for EF nulls
+
+Global curveball rounds pair up every molecule at random, and each pair
+shuffles the events that only one of them has, so every molecule keeps its
+number of events and every event keeps its number of molecules.
+"""
+
+import os
+import sys
+import logging
+import os.path as op
+from argparse import ArgumentParser
+
+import csv
+import multiprocessing
+import numpy as np
+from scipy import sparse
+
+module_path = os.path.realpath(os.path.dirname(__file__))
+labware_path = os.path.join(module_path, "..")
+sys.path.append(labware_path)
+from libraries.lab_utils import ScriptError, gopen
+from ef.ef_analysis import new_vocabulary, read_event_codes, \
+    edges_to_matrix, add_file_logger
+
+DEFAULT_SEED = 42
+DEFAULT_NUM_REPLICATES = 10
+DEFAULT_ROUNDS = 10
+
+# Edges and names shared with forked workers, so they are never pickled
+_worker_edges = None
+
+
+def curveball_round(rows, cols, num_rows, num_cols, random_state):
+    """Trade events within random molecule pairs in one vectorized round"""
+    order = random_state.permutation(num_rows)
+    pair_of_row = np.empty(num_rows, dtype=np.int64)
+    pair_of_row[order] = np.arange(num_rows) // 2
+    is_first = np.zeros(num_rows, dtype=bool)
+    is_first[order[0::2]] = True
+    num_pairs = (num_rows + 1) // 2
+    first_rows = order[0::2]
+    # An odd molecule out forms a pair with itself and keeps its events
+    second_rows = first_rows.copy()
+    second_rows[:num_rows // 2] = order[1::2]
+    pairs = pair_of_row[rows]
+    # Events held by both molecules of a pair stay where they are
+    keys = pairs * num_cols + cols
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    repeated = sorted_keys[1:] == sorted_keys[:-1]
+    shared = np.zeros(len(keys), dtype=bool)
+    shared[order[1:][repeated]] = True
+    shared[order[:-1][repeated]] = True
+    traded = ~shared
+    trade_pairs = pairs[traded]
+    first_counts = np.bincount(trade_pairs[is_first[rows[traded]]],
+                               minlength=num_pairs)
+    # Shuffle traded events within each pair, then deal the first molecule
+    # as many as it gave up, and the second molecule the rest. Pair codes
+    # are exact in float64, so a uniform offset shuffles with one argsort.
+    shuffle = np.argsort(trade_pairs + random_state.random_sample(
+        len(trade_pairs)))
+    trade_pairs = trade_pairs[shuffle]
+    trade_cols = cols[traded][shuffle]
+    starts = np.searchsorted(trade_pairs, np.arange(num_pairs))
+    positions = np.arange(len(trade_pairs)) - starts[trade_pairs]
+    trade_rows = np.where(positions < first_counts[trade_pairs],
+                          first_rows[trade_pairs], second_rows[trade_pairs])
+    return (np.concatenate([rows[shared], trade_rows]),
+            np.concatenate([cols[shared], trade_cols]))
+
+
+def randomize_edges(rows, cols, num_rows, num_cols, random_seed=DEFAULT_SEED,
+                    rounds=DEFAULT_ROUNDS):
+    """Degree preserving randomization of bipartite edges"""
+    random_state = np.random.RandomState(random_seed)
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    for i in xrange(rounds):
+        rows, cols = curveball_round(rows, cols, num_rows, num_cols,
+                                     random_state)
+    # Group by event for output, like typical events files
+    order = np.lexsort((rows, cols))
+    return rows[order], cols[order]
+
+
+def unique_edges(drug_codes, event_codes, num_rows, num_cols):
+    """Drop repeated molecule-event rows, which would break the swaps"""
+    drug_events = edges_to_matrix(drug_codes, event_codes,
+                                  (num_rows, num_cols)).tocoo()
+    return drug_events.row, drug_events.col
+
+
+def randomized_matrices(drug_events, num_replicates=DEFAULT_NUM_REPLICATES,
+                        random_seed=DEFAULT_SEED, rounds=DEFAULT_ROUNDS):
+    """Yield randomized copies of a sparse drug x event incidence matrix"""
+    drug_events = sparse.coo_matrix(drug_events)
+    num_rows, num_cols = drug_events.shape
+    for i in xrange(num_replicates):
+        rows, cols = randomize_edges(drug_events.row, drug_events.col,
+                                     num_rows, num_cols,
+                                     random_seed=random_seed + i,
+                                     rounds=rounds)
+        yield edges_to_matrix(rows, cols, drug_events.shape)
+
+
+def replicate_fn(out_fn, index):
+    """Name each replicate events file after the output file"""
+    base, ext = op.splitext(out_fn)
+    if ext in (".gz", ".bz2"):
+        base, inner = op.splitext(base)
+        ext = inner + ext
+    return "%s_%04d%s" % (base, index + 1, ext)
+
+
+def randomize_worker(task):
+    """Randomize the shared edges with one seed and write an events file"""
+    out_fn, random_seed, rounds = task
+    rows, cols, molecules, events = _worker_edges
+    rows, cols = randomize_edges(rows, cols, len(molecules), len(events),
+                                 random_seed=random_seed, rounds=rounds)
+    out_f = gopen(out_fn, "wb")
+    try:
+        out_writer = csv.writer(out_f)
+        for row, col in zip(rows, cols):
+            out_writer.writerow([molecules[row], events[col]])
+    finally:
+        out_f.close()
+    return out_fn
+
+
+def randomize_events(events_reader, out_fn,
+                     num_replicates=DEFAULT_NUM_REPLICATES,
+                     random_seed=DEFAULT_SEED, rounds=DEFAULT_ROUNDS, jobs=1):
+    """Write degree preserving randomized copies of an events file"""
+    global _worker_edges
+    if num_replicates < 1:
+        raise ScriptError("Need at least one replicate", 2)
+    if rounds < 1:
+        raise ScriptError("Need at least one curveball round", 2)
+    logging.info("Using random seed %d" % random_seed)
+    vocabulary = new_vocabulary()
+    (drug_codes, event_codes), has_event = read_event_codes(events_reader,
+                                                            vocabulary)
+    molecules = vocabulary["molecule"].names
+    events = vocabulary["event"].names
+    rows, cols = unique_edges(drug_codes, event_codes, len(molecules),
+                              len(events))
+    logging.info("Randomizing %d drug-event pairs with %d curveball rounds "
+                 "for %d replicates with %d jobs" % (len(rows), rounds,
+                 num_replicates, jobs))
+    # Seeds follow the replicate, so results do not depend on jobs
+    tasks = [(replicate_fn(out_fn, i), random_seed + i, rounds) for
+             i in xrange(num_replicates)]
+    _worker_edges = (rows, cols, molecules, events)
+    try:
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                for fn in pool.imap(randomize_worker, tasks):
+                    logging.info("Wrote randomized events file: %s" % fn)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for task in tasks:
+                logging.info("Wrote randomized events file: %s" %
+                             randomize_worker(task))
+    finally:
+        _worker_edges = None
+    logging.info("Finished")
+
+
+def handler(events_fn, out_fn, **kwargs):
+    """I/O handling for the script."""
+    logging.info("Events file: %s" % events_fn)
+    events_f = gopen(events_fn)
+    events_reader = csv.reader(events_f)
+    try:
+        try:
+            randomize_events(events_reader, out_fn, **kwargs)
+        except ScriptError, message:
+            logging.error(message)
+            return message.value
+    finally:
+        events_f.close()
+    return 0
+
+
+def main(argv):
+    """Parse arguments."""
+    log_level = logging.INFO
+    log_format = "%(levelname)s: %(message)s"
+    logging.basicConfig(level=log_level, format=log_format)
+    description = "Randomize an events file for EF null distributions, " + \
+                  "preserving the number of events for each molecule and " + \
+                  "the number of molecules for each event through " + \
+                  "curveball swaps. Replicates are written next to the " + \
+                  "output file with a numbered suffix."
+    parser = ArgumentParser(description=description)
+    parser.add_argument("events",
+                        help="Events file mapping molecules to events")
+    parser.add_argument("output",
+                        help="output events CSV file name, numbered for " +
+                             "each replicate")
+    parser.add_argument("-n", "--num-replicates", type=int,
+        default=DEFAULT_NUM_REPLICATES,
+        help="number of randomized events files (default: %(default)s)")
+    parser.add_argument("--rounds", type=int, default=DEFAULT_ROUNDS,
+        help="global curveball rounds per replicate (default: %(default)s)")
+    parser.add_argument("-r", "--random-seed", default=DEFAULT_SEED, type=int,
+                        help="set random integer seed (default: %(default)d)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+        help="Number of processes, one replicate each (default: %(default)s)")
+    options = parser.parse_args(args=argv[1:])
+    add_file_logger(options.output, log_format, log_level)
+    return handler(events_fn=options.events, out_fn=options.output,
+                   num_replicates=options.num_replicates,
+                   random_seed=options.random_seed, rounds=options.rounds,
+                   jobs=options.jobs)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
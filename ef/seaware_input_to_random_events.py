@@ -16,10 +16,10 @@ from argparse import ArgumentParser
 import csv
 import itertools
 import random
+import multiprocessing
 
 import numpy as np
 from sklearn.neighbors import KernelDensity
-from sklearn.grid_search import GridSearchCV
 
 
 module_path = os.path.realpath(os.path.dirname(__file__)) 
@@ -31,6 +31,10 @@ from libraries.lab_utils import ScriptError, gopen
 DEFAULT_SEED = 42
 DEFAULT_NUM_CLUSTERS = 200
 SIZE_MULTIPLIER = 1.0
+KDE_CHUNK_ENTRIES = 1 << 22
+
+# Histogram shared with forked fold workers, so it is never pickled per task
+_worker_histogram = None
 
 
 def silvermans_rule(data, verbose=False):
@@ -44,15 +48,88 @@ def silvermans_rule(data, verbose=False):
     return bandwidth_estimate
 
 
-def select_kde(data, crossfold=20):
+def fold_bounds(num_samples, crossfold):
+    """Contiguous fold boundaries, as in unshuffled KFold"""
+    sizes = np.repeat(num_samples // crossfold, crossfold)
+    sizes[:num_samples % crossfold] += 1
+    return np.concatenate([[0], np.cumsum(sizes)])
+
+
+def fold_scores(fold):
+    """Held-out Gaussian KDE log-likelihood of one fold per bandwidth"""
+    start, stop = fold
+    values, counts, codes, bandwidths = _worker_histogram
+    held = np.bincount(codes[start:stop], minlength=len(values))
+    train = counts - held
+    trained = train > 0
+    log_norm = np.log(bandwidths * np.sqrt(2 * np.pi))[:, None, None]
+    held_rows = np.nonzero(held)[0]
+    scores = np.zeros(len(bandwidths))
+    # Held-out values are scored against the training histogram in chunks,
+    # with the largest kernel term factored out so distant points never
+    # underflow
+    chunk = max(1, KDE_CHUNK_ENTRIES // (len(bandwidths) * trained.sum()))
+    for i in xrange(0, len(held_rows), chunk):
+        rows = held_rows[i:i+chunk]
+        diffs = values[rows][:, None] - values[trained][None, :]
+        log_kernel = -0.5 * (diffs[None, :, :] / 
+                             bandwidths[:, None, None]) ** 2 - log_norm
+        top = log_kernel.max(axis=2)
+        log_density = top + np.log(np.dot(
+            np.exp(log_kernel - top[:, :, None]), train[trained])) - \
+            np.log(train.sum())
+        scores += np.dot(log_density, held[rows])
+    return scores
+
+
+def select_bandwidth(data, bandwidths, crossfold=20, jobs=1):
+    """Bandwidth with the best crossfold held-out likelihood, scored over
+    a histogram of the data for every bandwidth at once"""
+    global _worker_histogram
+    data = np.asarray(data, dtype=np.float64)
+    values, codes, counts = np.unique(data, return_inverse=True,
+                                      return_counts=True)
+    logging.info("Scoring %d bandwidths over %d distinct values with %d jobs" %
+                 (len(bandwidths), len(values), jobs))
+    bounds = fold_bounds(len(data), crossfold)
+    folds = zip(bounds[:-1], bounds[1:])
+    _worker_histogram = (values, counts, codes, np.asarray(bandwidths))
+    try:
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                scores = pool.map(fold_scores, folds)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            scores = [fold_scores(fold) for fold in folds]
+    finally:
+        _worker_histogram = None
+    # Fold scores are log-likelihood sums, averaged weighted by fold size
+    # like GridSearchCV
+    sizes = np.diff(bounds)
+    mean_scores = np.dot(sizes, scores) / float(sizes.sum())
+    return bandwidths[np.argmax(mean_scores)]
+
+
+def select_kde(data, crossfold=20, jobs=1, grid_search=False):
     bw_est = silvermans_rule(data, verbose=True)
     logging.info("Selecting bandwidth through %d crossfold validation" %
                  crossfold)
-    grid = GridSearchCV(KernelDensity(),
-        {"bandwidth": np.linspace(0.1 * bw_est, 2.0 * bw_est, 39)},
-        cv=crossfold)
-    grid.fit(data[:, None])
-    kde = grid.best_estimator_
+    bandwidths = np.linspace(0.1 * bw_est, 2.0 * bw_est, 39)
+    if grid_search:
+        try:
+            from sklearn.model_selection import GridSearchCV
+        except ImportError:
+            from sklearn.grid_search import GridSearchCV
+        grid = GridSearchCV(KernelDensity(), {"bandwidth": bandwidths},
+                            cv=crossfold, n_jobs=jobs)
+        grid.fit(data[:, None])
+        kde = grid.best_estimator_
+    else:
+        kde = KernelDensity(bandwidth=select_bandwidth(data, bandwidths,
+            crossfold=crossfold, jobs=jobs)).fit(data[:, None])
     logging.info("Bandwidth selected by crossfold validation: %g" %
                  kde.bandwidth) 
     return kde
@@ -98,13 +175,13 @@ def read_molecule_ids(in_reader):
 
 def seaware_input_to_random_events(in_reader, targets_reader, 
         num_clusters=DEFAULT_NUM_CLUSTERS, seeded=False, 
-        random_seed=DEFAULT_SEED):
+        random_seed=DEFAULT_SEED, jobs=1, grid_search=False):
     """Create random event clusters for enrichment analysis"""
     logging.info("Using random seed %d" % random_seed)
     np.random.seed(random_seed)
     random.seed(random_seed)
     sizes, molecules = read_targets(targets_reader)
-    kde = select_kde(np.array(sizes))
+    kde = select_kde(np.array(sizes), jobs=jobs, grid_search=grid_search)
     cids = read_molecule_ids(in_reader)
     if seeded:
         logging.info("Seeding target molecules into input molecules")
@@ -167,6 +244,12 @@ def main(argv):
              "before random selection")
     parser.add_argument("-r", "--random-seed", default=DEFAULT_SEED, type=int, 
                         help="set random integer seed (default: %(default)d)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, 
+        help="number of processes for crossfold validation folds " + 
+             "(default: %(default)s)")
+    parser.add_argument("--grid-search", action="store_true", 
+        help="select the bandwidth with the original sklearn grid search " + 
+             "instead of scoring a histogram of target sizes")
     options = parser.parse_args(args=argv[1:])
     # Add file logger
     log_fn = options.output.replace(".csv", "") + ".log"
@@ -178,7 +261,8 @@ def main(argv):
     root_logger.addHandler(file_handler)
     return handler(in_fn=options.input, targets_fn=options.targets,
                    out_fn=options.output, num_clusters=options.num_clusters, 
-                   seeded=options.seeded)
+                   seeded=options.seeded, jobs=options.jobs, 
+                   grid_search=options.grid_search)
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""
+Copyright (C) 2015 Michael M Mysinger
+
+Regression tests for EF analysis.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import csv
+import numpy as np
+from scipy import stats
+
+module_path = os.path.realpath(os.path.dirname(__file__))
+labware_path = os.path.join(module_path, "..")
+sys.path.append(labware_path)
+from ef import ef_analysis
+
+RESULTS_HEADER = ["molecule id", "smiles", "target id", "affinity",
+                  "p-value", "max tc", "name", "description"]
+
+
+def random_inputs(num_molecules=300, num_targets=20, num_events=10,
+                  seed=42):
+    """Random events and SEAware results rows sharing one molecule pool"""
+    random_state = np.random.RandomState(seed)
+    molecules = ["MOL%04d" % i for i in xrange(num_molecules)]
+    events = []
+    for i in xrange(num_events):
+        for j in random_state.choice(num_molecules, 40, replace=False):
+            events.append([molecules[j], "event_%02d" % i])
+    results = []
+    for i in xrange(num_targets):
+        tid = "P%05d" % i
+        for j in random_state.choice(num_molecules, 50, replace=False):
+            results.append([molecules[j], "CCO", tid, "100", "1e-10", "0.5",
+                            "T%d_HUMAN" % i, "target %d" % i])
+    return events, results
+
+
+class EFAnalysisTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def path(self, fn):
+        return os.path.join(self.work_dir, fn)
+
+    def write_csv(self, fn, rows, header=None):
+        out_f = open(self.path(fn), "wb")
+        try:
+            writer = csv.writer(out_f)
+            if header:
+                writer.writerow(header)
+            writer.writerows(rows)
+        finally:
+            out_f.close()
+
+    def read_rows(self, fn):
+        in_f = open(self.path(fn), "rb")
+        try:
+            rows = list(csv.reader(in_f))
+        finally:
+            in_f.close()
+        return rows[0], sorted(rows[1:])
+
+    def run_ef(self, *args):
+        argv = ["ef_analysis.py", self.path("events.csv"),
+                self.path("results.csv")] + list(args)
+        self.assertEqual(ef_analysis.main(argv), 0)
+
+    def test_chi2_matches_scipy(self):
+        random_state = np.random.RandomState(42)
+        # Small counts put expected frequencies within 0.5 of observed
+        tables = random_state.randint(1, 20, size=(4, 500))
+        tables[:, :250] *= random_state.randint(1, 1000, size=(4, 250))
+        chi2, p_vals = ef_analysis.chi2_contingencies(
+            ef_analysis.Contingencies(*tables))
+        expected = np.array([stats.chi2_contingency([[a, b], [c, d]])[:2]
+                             for a, b, c, d in tables.T])
+        self.assertTrue(np.allclose(chi2, expected[:, 0], rtol=1e-10,
+                                    atol=0))
+        self.assertTrue(np.allclose(p_vals, expected[:, 1], rtol=1e-10,
+                                    atol=0))
+
+    def test_out_of_core_with_vocabulary(self):
+        events, results = random_inputs()
+        self.write_csv("events.csv", events)
+        # Targets interned in reverse file order get codes unlike a fresh run
+        self.write_csv("results.csv", results[::-1], RESULTS_HEADER)
+        vocabulary_fn = self.path("ids.voc")
+        self.run_ef(self.path("reversed.csv"), "--vocabulary", vocabulary_fn)
+        self.write_csv("results.csv", results, RESULTS_HEADER)
+        self.run_ef(self.path("in_memory.csv"), "-m", "0", "-e", "0",
+                    "-q", "1")
+        self.run_ef(self.path("out_of_core.csv"), "-m", "0", "-e", "0",
+                    "-q", "1", "--vocabulary", vocabulary_fn,
+                    "--memory-limit", "1")
+        self.assertEqual(self.read_rows("in_memory.csv"),
+                         self.read_rows("out_of_core.csv"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -9,6 +9,8 @@ Michael Mysinger 201504 Created
 
 import os
 import sys
+import gzip
+import bz2
 import logging
 import os.path as op
 from argparse import ArgumentParser
@@ -53,3 +55,53 @@ def float_close(x, y, threshold=0.5):
         return True
     else:
         return False
+
+
+class Interner(object):
+    """Map ID strings to dense integer codes, keeping strings for output."""
+
+    def __init__(self, names=()):
+        self.names = []
+        self.codes = {}
+        for name in names:
+            self.intern(name)
+
+    def intern(self, name):
+        """Return the code for name, assigning the next code if it is new."""
+        code = self.codes.get(name)
+        if code is None:
+            code = len(self.names)
+            self.codes[name] = code
+            self.names.append(name)
+        return code
+
+    def get(self, name, default=None):
+        """Return the code for name without interning it."""
+        return self.codes.get(name, default)
+
+    def __getitem__(self, code):
+        return self.names[code]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.codes
+
+
+def write_interners(out_f, interners):
+    """Write a dict of named interners as tab separated kind and ID lines."""
+    for kind in sorted(interners):
+        for name in interners[kind].names:
+            out_f.write("%s\t%s\n" % (kind, name))
+
+
+def read_interners(in_f):
+    """Read interners written by write_interners, preserving their codes."""
+    interners = {}
+    for line in in_f:
+        kind, name = line.rstrip("\r\n").split("\t", 1)
+        if kind not in interners:
+            interners[kind] = Interner()
+        interners[kind].intern(name)
+    return interners
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""
+Copyright (C) 2015 Michael M Mysinger
+
+Memory bounded multiple hypothesis testing corrections
+
+Reproduces the Holm and Benjamini-Hochberg q-values of statsmodels
+multipletests, storing p-values in a single float64 array and spilling
+sorted runs to disk when even that is too large.
+"""
+
+import os
+import sys
+import logging
+import os.path as op
+import shutil
+import tempfile
+
+import numpy as np
+
+METHODS = ("holm", "fdr_bh")
+# Runs merged at once, bounding open files, and the smallest block read
+# from each run, bounding seeks
+MERGE_FAN_IN = 64
+MIN_MERGE_BLOCK = 1 << 14
+
+
+def adjust_sorted(p_sorted, method, ranks, num_tests, previous=None):
+    """Adjust one block of sorted p-values, continuing a previous block"""
+    if method == "holm":
+        q_sorted = np.maximum.accumulate(p_sorted * (num_tests - ranks))
+        if previous is not None:
+            np.maximum(q_sorted, previous, out=q_sorted)
+    else:
+        # fdr_bh blocks arrive in descending order of p-value
+        q_sorted = np.minimum.accumulate(p_sorted /
+                                         ((ranks + 1) / float(num_tests)))
+        if previous is not None:
+            np.minimum(q_sorted, previous, out=q_sorted)
+    return q_sorted
+
+
+def adjust_in_memory(p_vals, method, num_tests=None):
+    """Step-down or step-up correction with a single argsort"""
+    count = len(p_vals)
+    if num_tests is None:
+        num_tests = count
+    order = np.argsort(p_vals)
+    ranks = np.arange(count)
+    if method == "holm":
+        q_sorted = adjust_sorted(p_vals[order], method, ranks, num_tests)
+    else:
+        order = order[::-1]
+        q_sorted = adjust_sorted(p_vals[order], method, ranks[::-1],
+                                 num_tests)
+    q_sorted[q_sorted > 1] = 1
+    q_vals = np.empty(count)
+    q_vals[order] = q_sorted
+    return q_vals
+
+
+def write_sorted_runs(p_vals, method, run_size, tmp_dir):
+    """Sort p-values in runs of run_size and save each run to disk"""
+    runs = []
+    for start in xrange(0, len(p_vals), run_size):
+        p_run = np.asarray(p_vals[start:start+run_size], dtype=np.float64)
+        # fdr_bh merges in descending order, so sort on negated keys
+        keys = p_run if method == "holm" else -p_run
+        order = np.argsort(keys, kind="mergesort")
+        run_fn = op.join(tmp_dir, "run_%06d" % len(runs))
+        np.save(run_fn + "_keys.npy", keys[order])
+        np.save(run_fn + "_indices.npy", (order + start).astype(np.int64))
+        runs.append(run_fn)
+    return runs
+
+
+class RunReader(object):
+    """Buffered block reader over one sorted run on disk"""
+
+    def __init__(self, run_fn, block_size):
+        self.keys = np.load(run_fn + "_keys.npy", mmap_mode="r")
+        self.indices = np.load(run_fn + "_indices.npy", mmap_mode="r")
+        self.block_size = block_size
+        self.start = 0
+        self.end = min(block_size, len(self.keys))
+
+    def buffered(self):
+        return self.end > self.start
+
+    def exhausted(self):
+        return self.end >= len(self.keys)
+
+    def last(self):
+        return self.keys[self.end - 1]
+
+    def take(self, bound):
+        """Remove and return buffered entries with keys <= bound"""
+        block = np.asarray(self.keys[self.start:self.end])
+        count = np.searchsorted(block, bound, side="right")
+        keys = block[:count]
+        indices = np.asarray(self.indices[self.start:self.start+count])
+        self.start += count
+        if self.start == self.end:
+            self.end = min(self.start + self.block_size, len(self.keys))
+        return keys, indices
+
+
+def merge_sorted_runs(runs, block_size):
+    """Yield merged blocks of (keys, indices) across all sorted runs"""
+    readers = [RunReader(run_fn, block_size) for run_fn in runs]
+    while True:
+        readers = [r for r in readers if r.buffered()]
+        if not readers:
+            break
+        # Anything at or below the smallest buffered maximum is final
+        pending = [r.last() for r in readers if not r.exhausted()]
+        bound = min(pending) if pending else np.inf
+        taken = [r.take(bound) for r in readers]
+        keys = np.concatenate([k for k, i in taken])
+        indices = np.concatenate([i for k, i in taken])
+        order = np.argsort(keys, kind="mergesort")
+        yield keys[order], indices[order]
+
+
+def run_length(run_fn):
+    """Number of p-values held in one sorted run on disk"""
+    return len(np.load(run_fn + "_keys.npy", mmap_mode="r"))
+
+
+def merge_to_run(runs, block_size, run_fn):
+    """Merge several sorted runs into one longer sorted run on disk"""
+    num_keys = sum(run_length(fn) for fn in runs)
+    keys = np.lib.format.open_memmap(run_fn + "_keys.npy", mode="w+",
+                                     dtype=np.float64, shape=(num_keys,))
+    indices = np.lib.format.open_memmap(run_fn + "_indices.npy", mode="w+",
+                                        dtype=np.int64, shape=(num_keys,))
+    start = 0
+    for block_keys, block_indices in merge_sorted_runs(runs, block_size):
+        stop = start + len(block_keys)
+        keys[start:stop] = block_keys
+        indices[start:stop] = block_indices
+        start = stop
+    keys.flush()
+    indices.flush()
+    del keys, indices
+    for fn in runs:
+        os.remove(fn + "_keys.npy")
+        os.remove(fn + "_indices.npy")
+    return run_fn
+
+
+def merge_passes(runs, block_size, tmp_dir):
+    """Merge runs MERGE_FAN_IN at a time until one final merge is left"""
+    level = 0
+    while len(runs) > MERGE_FAN_IN:
+        logging.info("Merging %d sorted p-value runs in groups of %d" %
+                     (len(runs), MERGE_FAN_IN))
+        runs = [merge_to_run(runs[i:i+MERGE_FAN_IN], block_size,
+                             op.join(tmp_dir, "merge_%d_%06d" %
+                                     (level, i // MERGE_FAN_IN)))
+                for i in xrange(0, len(runs), MERGE_FAN_IN)]
+        level += 1
+    return runs
+
+
+def adjust_external(p_vals, method, max_in_memory, tmp_dir=None,
+                    num_tests=None):
+    """Correction over sorted runs spilled to disk and merged in blocks"""
+    num_pvals = len(p_vals)
+    if num_tests is None:
+        num_tests = num_pvals
+    work_dir = tempfile.mkdtemp(prefix="multitest_", dir=tmp_dir)
+    try:
+        runs = write_sorted_runs(p_vals, method, max_in_memory, work_dir)
+        block_size = max(MIN_MERGE_BLOCK,
+                         max_in_memory // (min(len(runs), MERGE_FAN_IN) + 1))
+        runs = merge_passes(runs, block_size, work_dir)
+        logging.info("Merging %d sorted p-value runs from disk" % len(runs))
+        # Disk backed output, unlinked so it disappears with the array
+        q_fn = op.join(work_dir, "q_values.dat")
+        q_vals = np.memmap(q_fn, dtype=np.float64, mode="w+",
+                           shape=(num_pvals,))
+        os.remove(q_fn)
+        rank = 0
+        previous = None
+        for keys, indices in merge_sorted_runs(runs, block_size):
+            count = len(keys)
+            if method == "holm":
+                p_sorted = keys
+                ranks = np.arange(rank, rank + count)
+            else:
+                p_sorted = -keys
+                ranks = np.arange(num_pvals - rank - 1,
+                                  num_pvals - rank - count - 1, -1)
+            q_sorted = adjust_sorted(p_sorted, method, ranks, num_tests,
+                                     previous)
+            previous = q_sorted[-1]
+            q_sorted[q_sorted > 1] = 1
+            q_vals[indices] = q_sorted
+            rank += count
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return q_vals
+
+
+def adjust_pvalues(p_vals, method="holm", max_in_memory=None, tmp_dir=None,
+                   num_tests=None):
+    """Holm or Benjamini-Hochberg q-values, bounded to max_in_memory
+
+    When p_vals holds only some of num_tests tests, the untested p-values
+    are taken to be larger, which keeps both corrections conservative.
+    """
+    if method not in METHODS:
+        raise ValueError("Unknown multiple testing method: %s" % method)
+    if num_tests is not None and num_tests < len(p_vals):
+        raise ValueError("Fewer tests than p-values: %d" % num_tests)
+    if max_in_memory is None or len(p_vals) <= max_in_memory:
+        return adjust_in_memory(np.asarray(p_vals, dtype=np.float64), method,
+                                num_tests=num_tests)
+    return adjust_external(p_vals, method, max_in_memory, tmp_dir=tmp_dir,
+                           num_tests=num_tests)